@@ -1,7 +1,10 @@
 import os
 import json
+import asyncio
 import urllib3
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 import wechaty
 from paddlenlp import Taskflow
@@ -18,7 +21,23 @@ from wechaty import (
 )
 from wechaty_puppet import get_logger
 from utils.DFAFilter import DFAFilter
+from utils.rasa_client import RasaClient
+from utils.intent_classifier import IntentClassifier
+from utils.lru_cache import TTLCache
+from utils.batcher import MicroBatcher
+from utils.uie_pool import UIEProcessPool
+from utils import uie_backend
+from utils.extraction_cache import ExtractionCache
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from utils.user_store import Session, SessionCache, UserStore
+from utils.journal import Journal, orphans, shard_path
+from utils.prompt import PromptAssembler
+from utils.semantic_index import BowEmbedder, HashingEmbedder, SemanticIndex
+from utils.contact_queue import ContactQueue
+from utils.admission import ACTIVE, NEW_USER, AdmissionController, Busy
+from utils.write_behind import WriteBehind
 from plugins.inspurai.inspurai import Yuan
+from plugins.inspurai.prompt_cache import PromptCache
 
 
 class DramaPlugin(WechatyPlugin):
@@ -32,7 +51,39 @@ class DramaPlugin(WechatyPlugin):
             self,
             options: Optional[WechatyPluginOptions] = None,
             configs: str = 'drama_configs',
-            port: str = '5005'
+            port: str = '5005',
+            rasa_timeout: float = 5,
+            rasa_concurrency: int = 8,
+            intent_cache_size: int = 2048,
+            intent_cache_ttl: float = 3600,
+            intent_model: Optional[str] = 'intent_classifier.json',
+            intent_threshold: float = 0.9,
+            uie_batch_size: int = 16,
+            uie_batch_wait: float = 0.01,
+            uie_workers: int = 0,
+            uie_precision: str = 'fp32',
+            uie_max_seq_len: int = 512,
+            uie_num_threads: Optional[int] = None,
+            yuan_cache_size: int = 1024,
+            yuan_cache_ttl: float = 86400,
+            memory_entity_cap: int = 50,
+            memory_recall: int = 20,
+            session_capacity: int = 1000,
+            session_idle_timeout: float = 1800,
+            journal_compact_interval: float = 60,
+            journal_fsync: bool = False,
+            prompt_budget: int = 1000,
+            self_memory_retrieval: str = 'entity',
+            self_memory_top_k: int = 5,
+            debounce: float = 1.0,
+            debounce_max: float = 5.0,
+            max_active_turns: int = 32,
+            max_waiting_turns: int = 64,
+            stage_limits: Optional[dict] = None,
+            write_behind_size: int = 256,
+            write_behind_workers: int = 2,
+            shard: int = 0,
+            shards: int = 1
     ) -> None:
 
         super().__init__(options)
@@ -47,7 +98,10 @@ class DramaPlugin(WechatyPlugin):
         os.makedirs(self.file_cache_dir, exist_ok=True)
 
         # 2. save the log info into <plugin_name>.log file
-        log_file = os.path.join(self.cache_dir, 'log.log')
+        # shard and shards are set when the plugin runs as one of the workers of ShardedDramaPlugin
+        self.shard = shard
+        self.shards = shards
+        log_file = os.path.join(self.cache_dir, 'log.log' if shards <= 1 else f'log.{shard}.log')
         self.logger = get_logger(self.name, log_file)
 
         # 3. check and load metadata
@@ -71,55 +125,129 @@ class DramaPlugin(WechatyPlugin):
             self.logger.warning('there must be at least one in the focus.json and no empty should be, pls retry')
             raise RuntimeError('Drama focus.json not valid, pls refer to above info and try again')
 
+        # fp32 or int8 static graph, compare the options with: python -m utils.uie_backend compare <configs>
+        if uie_workers > 0 and uie_num_threads is None:
+            # the workers share the cores instead of each taking half of them
+            uie_num_threads = max(1, (os.cpu_count() or 1) // uie_workers)
+        uie_options = uie_backend.taskflow_kwargs(uie_batch_size, uie_max_seq_len, uie_num_threads)
         try:
-            self.uie = Taskflow('information_extraction', schema=schema, task_path='uie/checkpoint/model_best')
+            uie_task_path = uie_backend.prepare('uie/checkpoint/model_best', uie_precision)
+            if uie_workers > 0:
+                # extraction runs on worker processes, every worker loads the model once
+                self.uie = UIEProcessPool(uie_workers, schema, uie_task_path,
+                                          taskflow_kwargs=uie_options,
+                                          chunk_size=uie_batch_size, logger=self.logger)
+                self.uie.start()
+            else:
+                self.uie = Taskflow('information_extraction', schema=schema, task_path=uie_task_path, **uie_options)
         except Exception as e:
             self.logger.error('load uie failed, pls check the uie/checkpoint/model_best, be sure right model files exits')
             raise e
-
-        self.self_memory, self.user_memory_template = self._load_memory()
-        if self.self_memory is None:
-            raise RuntimeError('Drada memory.txt not valid, pls refer to above info and try again')
-
-        if "user_memory.json" in self.config_files:
-            with open(os.path.join(self.config_url, 'user_memory.json'), 'r', encoding='utf-8') as f:
-                self.user_memory = json.load(f)
+        # turn-time extraction of concurrent conversations is batched and run off the event loop,
+        # with a process pool several batches can be in flight at the same time
+        self.uie_batcher = MicroBatcher(self.uie, max_batch_size=uie_batch_size, max_wait=uie_batch_wait,
+                                        executor=ThreadPoolExecutor(max_workers=max(uie_workers, 1)))
+
+        # optional: recall self memory by embedding similarity to the message instead of exact entity match
+        if self_memory_retrieval == 'entity':
+            self.memory_index = None
+        elif self_memory_retrieval == 'hash':
+            self.memory_index = SemanticIndex(HashingEmbedder(), top_k=self_memory_top_k)
+        elif self_memory_retrieval == 'bow':
+            self.memory_index = SemanticIndex(BowEmbedder(), top_k=self_memory_top_k)
         else:
-            self.user_memory = {}
+            raise RuntimeError("self_memory_retrieval must be one of ['entity', 'hash', 'bow']")
+
+        # memory.txt lines that did not change since the last run skip the inference
+        self.memory_cache = ExtractionCache(os.path.join(self.cache_dir, 'memory_uie_cache.json'),
+                                            schema, uie_task_path,
+                                            {'precision': uie_precision, 'max_seq_len': uie_max_seq_len})
+        datas = self._read_memory()
+        if datas is None:
+            raise RuntimeError('Drada memory.txt not valid, pls refer to above info and try again')
+        self.self_memory, self.memory_order = self._load_memory(datas, self._extract_memory(datas))
 
-        if "users.json" in self.config_files:
-            with open(os.path.join(self.config_url, 'users.json'), 'r', encoding='utf-8') as f:
-                self.users = json.load(f)
-        else:
-            self.users = {}
+        # user memory is kept per user in a time ordered store, at most memory_entity_cap entries per entity,
+        # and at most memory_recall entries are recalled into a prompt
+        self.memory_recall = memory_recall
+        # prompts are cut to prompt_budget characters, memory segments are ranked by relevance and recency
+        self.prompt = PromptAssembler(prompt_budget)
 
         # 5. load scenario rule-table
         self.scenarios, self.last_turn_memory_template = self._load_scenarios()
         if self.scenarios is None:
             raise RuntimeError('Drada scenarios.xlsx not valid, pls refer to above info and try again. make sure at lease one scenario is well defined.')
 
-        self.last_turn_memory = {}
-        if self.user_memory:
-            for key in self.user_memory.keys():
-                self.last_turn_memory[key] = self.last_turn_memory_template
+        # users(status, memory, last turn) are stored in users.db, loaded on their first message
+        # and kept in an LRU of active sessions, idle users are written back to disk
+        self.store = UserStore(os.path.join(self.config_url, 'users.db'))
+        if len(self.store) == 0 and "users.json" in self.config_files:
+            with open(os.path.join(self.config_url, 'users.json'), 'r', encoding='utf-8') as f:
+                users = json.load(f)
+            user_memory = {}
+            if "user_memory.json" in self.config_files:
+                with open(os.path.join(self.config_url, 'user_memory.json'), 'r', encoding='utf-8') as f:
+                    user_memory = json.load(f)
+            self.store.import_json(users, user_memory)
+            self.logger.info(f'{len(users)} users imported from users.json and user_memory.json')
+
+        # status and memory changes are journaled as they happen and compacted into users.db in the background
+        # every shard has a journal of its own, journals of a run with another number of shards are taken over
+        journal_path = os.path.join(self.config_url, 'users.journal')
+        self.journal = Journal(shard_path(journal_path, shard, shards), fsync=journal_fsync)
+        self.journal_compact_interval = journal_compact_interval
+        self.sessions = SessionCache(self.store, self.last_turn_memory_template, capacity=session_capacity,
+                                     idle_timeout=session_idle_timeout, memory_cap=memory_entity_cap,
+                                     journal=self.journal)
+        replayed = 0
+        for path in orphans(journal_path, shard, shards):
+            orphan = Journal(path)
+            replayed += self.sessions.replay(orphan)
+            orphan.close()
+            os.remove(path)
+        replayed += self.sessions.replay()
+        if replayed:
+            self.logger.info(f'{replayed} journal records replayed into users.db')
+        if self.sessions.replay_skipped:
+            self.logger.warning(f'{self.sessions.replay_skipped} journal records skipped, their users are not in users.db')
+        self._compact_task = None
 
         # 6. initialize & test the rasa nlu server and yuan-api
         self.rasa_url = 'http://localhost:'+port+'/model/parse'
-        self.http = urllib3.PoolManager()
+        # the startup check is blocking, all turn-time lookups go through the async client
+        http = urllib3.PoolManager()
 
         _test_data = {'text': '苍老师德艺双馨'}
         _encoded_data = json.dumps(_test_data)
-        _test_res = self.http.request('POST', self.rasa_url, body=_encoded_data)
+        _test_res = http.request('POST', self.rasa_url, body=_encoded_data)
         _result = json.loads(_test_res.data)
 
         if not _result:
             raise RuntimeError('Rasa server not running, pls start it first and trans the right port in str')
 
+        intent_cache = TTLCache(intent_cache_size, intent_cache_ttl) if intent_cache_size > 0 else None
+
+        # confident intents are classified in process, the rest is sent to rasa
+        # train it with: python -m utils.intent_classifier train <rasa data dir> -o <configs>/intent_classifier.json
+        self.intent_classifier = None
+        if intent_model:
+            intent_model_path = os.path.join(self.config_url, intent_model)
+            if os.path.exists(intent_model_path):
+                self.intent_classifier = IntentClassifier.load(intent_model_path, intent_threshold)
+                self.logger.info(f'fast-path intent classifier loaded from {intent_model_path}')
+        self.rasa = RasaClient('http://localhost:'+port, timeout=rasa_timeout, max_concurrency=rasa_concurrency,
+                               cache=intent_cache)
+
+        yuan_cache = None
+        if yuan_cache_size > 0:
+            yuan_cache = PromptCache(os.path.join(self.cache_dir, 'yuan_cache.db'), yuan_cache_size, yuan_cache_ttl)
         self.yuan = Yuan(engine='dialog',
                     input_prefix="",
                     input_suffix="",
                     output_prefix="",
-                    output_suffix="",)
+                    output_suffix="",
+                    cache=yuan_cache,
+                    breaker=CircuitBreaker('yuan', slow_call=10, open_duration=30))
 
         engine_name = self.yuan.get_engine()
         self.logger.info(f'with yuan engine:{engine_name},with temperature=0.9,max_tokens=100,topK=1,topP=0.9')
@@ -128,12 +256,64 @@ class DramaPlugin(WechatyPlugin):
         self.gfw = DFAFilter()
         self.gfw.parse()
 
+        # turns of one contact run one after another, quick successive messages are merged into one turn
+        self.queue = ContactQueue(self._turn, debounce=debounce, max_delay=debounce_max, logger=self.logger)
+
+        # bound the turns in flight, and the concurrency of every stage of a turn
+        if stage_limits is None:
+            stage_limits = {'intent': rasa_concurrency, 'extraction': uie_batch_size, 'generation': 16}
+        self.admission = AdmissionController(max_active_turns, max_waiting_turns, stage_limits)
+
+        # memory of the replies is extracted and written after the turn, in the background
+        self.write_behind = WriteBehind(write_behind_size, write_behind_workers, logger=self.logger)
+
+        self.busy_reply = '我这会儿有点忙不过来，请稍等一会儿再和我说话吧'
+        # while Yuan is out of service, for scenarios without a FALLBACK row
+        self.fallback_reply = '我刚刚走神了，你能再说一遍吗'
+
         self.take_over = False
         self.temp_talker: [wechaty.Contact] = None
         self.take_over_director: [wechaty.Contact] = None
 
         self.logger.info('Drada plugin init success')
 
+    async def init_plugin(self, wechaty: wechaty.Wechaty) -> None:
+        await super().init_plugin(wechaty)
+        # background jobs need the running loop
+        if self._compact_task is None:
+            self._compact_task = asyncio.create_task(self._compact_forever())
+        self.write_behind.start()
+
+    async def close(self) -> None:
+        """finish the queued turns and memory writes, then save everything and release the clients"""
+        await self.queue.join()
+        await self.write_behind.close()
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+            await asyncio.gather(self._compact_task, return_exceptions=True)
+            self._compact_task = None
+        await self.sessions.compact()
+        self.journal.close()
+        self.store.close()
+        await self.rasa.close()
+        await self.yuan.close()
+        if self.yuan.cache is not None:
+            self.yuan.cache.close()
+        if isinstance(self.uie, UIEProcessPool):
+            self.uie.close()
+
+    async def _compact_forever(self) -> None:
+        """write the journaled changes into users.db periodically"""
+        while True:
+            await asyncio.sleep(self.journal_compact_interval)
+            if self.journal.records == 0 and self.sessions.unsaved == 0:
+                continue
+            try:
+                # close() cancels this task, a compaction it interrupts still finishes its write
+                await asyncio.shield(self.sessions.compact())
+            except Exception as e:
+                self.logger.error(f'journal compaction failed, will retry: {e}')
+
     def _file_check(self) -> bool:
         """check the config file"""
 
@@ -157,20 +337,27 @@ class DramaPlugin(WechatyPlugin):
             self.logger.warning(f'config file url:/{self.config_url} does not have scenarios.xlsx!')
             return False
 
-    def _load_memory(self) -> None or dict:
-        """load the memory data"""
+    def _read_memory(self) -> None or list:
+        """the lines of memory.txt"""
         memory_file = os.path.join(self.config_url, 'memory.txt')
         with open(memory_file, 'r', encoding='utf-8') as f:
             datas = [line.strip() for line in f.readlines() if line.strip()]
 
         if len(datas) == 0:
             self.logger.warning('no data in memory.txt,this is not allowed')
-            return None, None
+            return None
+        return datas
 
-        focus = self.uie(datas)
+    def _extract_memory(self, datas: list) -> list:
+        """uie results of the memory lines, blocking, must not run beside the batcher's inference"""
+        misses = self.memory_cache.misses
+        focus = self.memory_cache.extract(datas, self.uie)
+        self.logger.info(f'memory.txt: {len(datas)} lines, {self.memory_cache.misses - misses} of them extracted by uie')
+        return focus
 
+    def _load_memory(self, datas: list, focus: list) -> tuple:
+        """load the memory data"""
         self_memory = {}
-        user_memory_template = {}
         for i in range(len(datas)):
             for result in focus[i].values():
                 for entity in result:
@@ -179,9 +366,12 @@ class DramaPlugin(WechatyPlugin):
                             self_memory[entity['text']].append(datas[i])
                         else:
                             self_memory[entity['text']] = [datas[i]]
-                            user_memory_template[entity['text']] = []
 
-        return self_memory, user_memory_template
+        if self.memory_index is not None:
+            self.memory_index.build(datas)
+        # line -> position in memory.txt, recalled lines are put into the prompt in this order
+        memory_order = {line: i for i, line in reversed(list(enumerate(datas)))}
+        return self_memory, memory_order
 
     def _load_mmrules(self) -> None or dict:
         """load the Memory Mathmatics Rules from excel"""
@@ -255,6 +445,25 @@ class DramaPlugin(WechatyPlugin):
         return rules, last_turn_memory_template
 
 
+    def _stats(self) -> dict:
+        """statistics shown to directors by the stats command"""
+        stats = {}
+        if self.rasa.cache is not None:
+            stats['intent cache'] = self.rasa.cache.stats()
+        if self.intent_classifier is not None:
+            stats['intent fast path'] = self.intent_classifier.stats()
+        stats['uie batcher'] = self.uie_batcher.stats()
+        if self.yuan.cache is not None:
+            stats['yuan cache'] = self.yuan.cache.stats()
+        stats['yuan breaker'] = self.yuan.breaker.stats()
+        stats['sessions'] = self.sessions.stats()
+        stats['queue'] = self.queue.stats()
+        stats['admission'] = self.admission.stats()
+        stats['write behind'] = self.write_behind.stats()
+        if isinstance(self.uie, UIEProcessPool):
+            stats['uie workers'] = self.uie.stats()
+        return stats
+
     async def director_message(self, msg: Message):
         """
         Director Module
@@ -272,7 +481,8 @@ class DramaPlugin(WechatyPlugin):
                           "reload mmrules -- reload MMrules.xlsx \n"
                           "reload memory -- reload memory.txt \n"
                           "reload scenarios -- reload scenarios.xlsx \n"
-                          "save -- save the users status and users memory so that game will continue instead of restart\n"
+                          "save -- save the users status and users memory now (it is also done in the background every minute)\n"
+                          "stats -- show the cache statistics \n"
                           "take over -- take over the AI for a time \n"
                           "take over off -- stop the take_over")
             return
@@ -297,12 +507,16 @@ class DramaPlugin(WechatyPlugin):
             return
 
         if msg.text() == 'reload memory':
-            selfmemory, user_memory_template = self._load_memory()
-            if selfmemory is None:
+            datas = self._read_memory()
+            if datas is None:
                 await msg.say("memory.txt is empty, so I will not change my memory")
             else:
+                # the predictor is not thread-safe, extract on the batcher's executor where turn-time batches run
+                focus = await asyncio.get_running_loop().run_in_executor(self.uie_batcher.executor,
+                                                                         self._extract_memory, datas)
+                selfmemory, memory_order = self._load_memory(datas, focus)
                 self.self_memory = selfmemory
-                self.user_memory_template = user_memory_template
+                self.memory_order = memory_order
                 await msg.say("self memory has been updated.\n"
                               "Attention: it'a actually very dagerous to change the memory during program running")
             return
@@ -316,21 +530,23 @@ class DramaPlugin(WechatyPlugin):
             else:
                 self.scenarios = scenarios
                 self.last_turn_memory_template = last_turn_memory_template
+                self.sessions.last_turn_template = last_turn_memory_template
                 await msg.say("scenarios has been updated")
             return
 
         if msg.text() == 'save':
-            with open(os.path.join(self.config_url, 'users.json'), 'w', encoding='utf-8') as f:
-                json.dump(self.users, f)
-            with open(os.path.join(self.config_url, 'user_memory.json'), 'w', encoding='utf-8') as f:
-                json.dump(self.user_memory, f)
-            # for director may change the people of scenarios during restart, so we donot save the last_turn_memory
-            await msg.say(f"user status and memory has been saved in {self.config_url}. I'll read instead of create new till you delete the files")
+            await self.write_behind.flush()
+            await self.sessions.compact()
+            await msg.say(f"user status and memory has been saved in {self.store.path}. I'll read instead of create new till you delete the file")
+            return
+
+        if msg.text() == 'stats':
+            await msg.say('\n'.join(f'{name}: {stats}' for name, stats in self._stats().items()))
             return
 
         if msg.text() == "take over":
             self.take_over = True
-            self.take_over_director = await self.bot.Contact.find(msg.talker().name)
+            self.take_over_director = msg.talker()
             await msg.say("ok your turn. to give the wheel back to me send: take over off")
             return
 
@@ -342,19 +558,24 @@ class DramaPlugin(WechatyPlugin):
         if self.take_over:
             await msg.forward(self.temp_talker)
             await msg.say(f"msg has been forward to {self.temp_talker.name}")
-            self.last_turn_memory[self.temp_talker.contact_id][self.users[self.temp_talker.contact_id][1]][self.users[self.temp_talker.contact_id][0]].append(f'你说：“{msg.text()}”')
+            session = self.sessions.get(self.temp_talker.contact_id)
+            session.last_turn[session.scenario][session.character].append(f'你说：“{msg.text()}”')
+            self.sessions.touch(session)
         else:
             await msg.say("send help to me to check what you can do")
 
-    def nlu_intent(self, text: str) -> str:
-        _test_data = {'text': text}
-        _encoded_data = json.dumps(_test_data)
-        _test_res = self.http.request('POST', self.rasa_url, body=_encoded_data)
-        _result = json.loads(_test_res.data)
-        return _result['intent']['name']
-
-    def nlu_info(self, text:Union[str,list]) -> list:
-        results = self.uie(text)
+    async def nlu_intent(self, text: str) -> str:
+        if self.intent_classifier is not None:
+            intent = self.intent_classifier.match(text)
+            if intent in self.mmrules:
+                return intent
+        async with self.admission.stage('intent'):
+            return await self.rasa.intent(text)
+
+    async def nlu_info(self, text:Union[str,list]) -> list:
+        texts = [text] if isinstance(text, str) else text
+        async with self.admission.stage('extraction'):
+            results = await self.uie_batcher.submit_many(texts)
         infos = []
         for _result in results:
             info = []
@@ -362,42 +583,41 @@ class DramaPlugin(WechatyPlugin):
                 for entity in result:
                     if entity['probability'] > 0.6:
                         info.append(entity['text'])
-            infos.append(list(set(info)))
+            # deduplicated in extraction order, set order would differ between processes
+            infos.append(list(dict.fromkeys(info)))
         return infos
 
-    async def soul(self, text: str, talker: Contact, scenario: str, character: str, memory: dict, last_dialog: str, rules:dict) -> None:
+    def _fallback_reply(self, rules: dict) -> str:
+        """one of the canned replies(one per line) in the optional FALLBACK row of the scenario, or the built-in one"""
+        lines = [line for line in rules.get('FALLBACK', '').split('\n') if line.strip()]
+        if not lines:
+            return self.fallback_reply
+        line = random.choice(lines)
+        return line[1:] if line.startswith('S') else line
+
+    async def soul(self, text: str, talker: Contact, session: Session, scenario: str, character: str, last_dialog: str, rules:dict) -> None:
         # 1. intent judgment, focus information_extraction acton-squence
-        intent = self.nlu_intent(text)
-        info = self.nlu_info(text)[0]
+        memory = session.memory
+        # intent(rasa) and entities(uie) do not depend on each other, wait for the slower one only
+        intent, infos = await asyncio.gather(self.nlu_intent(text), self.nlu_info(text))
+        info = infos[0]
+
+        # 2. act the actions
+        user_memory = []
+        selfmemory_hits = {}
+        if self.memory_index is not None and self.mmrules[intent]['read'] == 'yes':
+            # self memory lines most similar to the message, with their cosine score
+            selfmemory_hits = dict(self.memory_index.search(text))
 
-        # 2. act the action in sequence
-        memory_text = ''
-        selfmemory_text = ''
         if len(info) > 0 and self.mmrules[intent]['read'] == 'yes':
-            memory_squence = []
-            for entity in info:
-                if entity in memory.keys():
-                    memory_squence += memory[entity]
-            if len(memory_squence) > 0:
-                memory_squence.sort(key=lambda k: (k.get('time')), reverse=False)
-                for sentence in memory_squence:
-                    memory_text += sentence['text']
-
-            selfmemory_squence = []
-            for entity in info:
-                if entity in self.self_memory.keys():
-                    selfmemory_squence += self.self_memory[entity]
-            selfmemory_text = ''.join(set(selfmemory_squence))
-
-        if len(selfmemory_text) > 0:
-            pre_prompt = "你记得：" + selfmemory_text + "……现在" + rules['DESCRIPTION']
-        else:
-            pre_prompt = rules['DESCRIPTION']
+            user_memory = memory.recall(info, self.memory_recall)
 
-        if len(memory_text) > 0:
-            pre_prompt += "，" + memory_text + "，" + last_dialog + character + "说：“" + text + "”你"
-        else:
-            pre_prompt += "，" + last_dialog + character + "说：“" + text + "”你"
+            # self memory lines with the number of entities they are recalled by
+            if self.memory_index is None:
+                for entity in info:
+                    if entity in self.self_memory.keys():
+                        for line in self.self_memory[entity]:
+                            selfmemory_hits[line] = selfmemory_hits.get(line, 0) + 1
 
         addtion_action = ''
         for entity in info:
@@ -405,57 +625,81 @@ class DramaPlugin(WechatyPlugin):
                 addtion_action = rules[entity]
                 break
 
-        pre_prompt += addtion_action
-
         if intent in rules.keys():
             actions_txt = rules[intent]
             actions = actions_txt.split('\n')
         else:
             actions = ['']
 
-        replies = []
-        for action in actions:
+        reserve = max(len(action) for action in actions) + len("说：“")
+        # memory.txt order, so that the same turn always gives the same prompt(and hits the prompt cache)
+        selfmemory_hits = sorted(selfmemory_hits.items(), key=lambda hit: self.memory_order.get(hit[0], 0))
+        pre_prompt = self.prompt.build(rules['DESCRIPTION'], selfmemory_hits, user_memory,
+                                       last_dialog, character, text, addtion_action, reserve)
+
+        # all the actions share pre_prompt, generate them concurrently and keep the action order
+        degraded = []
+
+        async def act(action: str) -> Optional[str]:
             if action.startswith('S'):
-                reply = action[1:]
-            else:
-                prompt = pre_prompt + action + "说：“"
-                self.logger.info(prompt)
-                self.logger.info("----------------------------\n")
-                reply = self.yuan.submit_API(prompt, trun="”")
-                if reply is None:
-                    self.logger.warning(f'generation failed with the following input:{character},{intent},{action},{text},{scenario}')
-                    continue
-                if reply == "somethingwentwrongwithyuanservice":
-                    self.logger.warning(f'Yuan is out of service, failed from:{character},{talker.name},{text},{scenario}')
-                    continue
+                return action[1:]
+            prompt = pre_prompt + action + "说：“"
+            self.logger.info(prompt)
+            self.logger.info("----------------------------\n")
+            try:
+                async with self.admission.stage('generation'):
+                    reply = await self.yuan.asubmit_API(prompt, trun="”")
+            except CircuitOpenError:
+                degraded.append(action)
+                return None
+            except Exception as e:
+                self.logger.warning(f'generation failed with the following input:{character},{intent},{action},{text},{scenario}, {e}')
+                return None
+            if reply is None:
+                self.logger.warning(f'generation failed with the following input:{character},{intent},{action},{text},{scenario}')
+                return None
+            if reply == "somethingwentwrongwithyuanservice":
+                self.logger.warning(f'Yuan is out of service, failed from:{character},{talker.name},{text},{scenario}')
+                return None
+            return reply
+
+        generated = [reply for reply in await asyncio.gather(*[act(action) for action in actions]) if reply is not None]
+
+        # Yuan is out of service, answer with a canned line instead of waiting
+        if degraded and not generated:
+            fallback = self._fallback_reply(rules)
+            self.logger.warning(f'Yuan circuit is open, fallback reply {fallback} for:{character},{talker.name},{text},{scenario}')
+            generated.append(fallback)
+
+        # screen all the replies of this turn together before sending
+        replies = []
+        for reply, hits in zip(generated, self.gfw.filter_many(generated)):
+            if hits:
+                self.logger.warning(f'reply {reply} is filtered, for the reason of {[word for _, word in hits]}')
+                continue
             await talker.say(reply)
-            self.last_turn_memory[talker.contact_id][scenario][character].append(f'你说：“{reply}”')
+            session.last_turn[scenario][character].append(f'你说：“{reply}”')
             replies.append(reply)
 
         # 3. memory saving
-        t = time.time()
-        for entity in info:
-            if entity in memory.keys():
-                memory[entity].append({"time":t, "text":f'{character}说：“{text}”'})
-            else:
-                memory[entity] = [{"time":t, "text":f'{character}说：“{text}”'}]
+        self.sessions.touch(session)
+        self.sessions.remember(session, character, text, info)
 
         if self.mmrules[intent]['bi'] == 'no':
             return
 
-        infos = self.nlu_info(replies)
+        if not replies:
+            return
+
+        # the extraction of the replies is off the critical path, the next turn of the contact waits for it
         t = time.time()
-        for i in range(len(replies)):
-            if len(infos[i]) == 0:
-                continue
-            for entity in infos[i]:
-                if entity in memory.keys():
-                    memory[entity].append({"time": t, "text": f'你说：“{replies[i]}”'})
-                else:
-                    memory[entity] = [{"time": t, "text": f'你说：“{replies[i]}”'}]
 
-        self.user_memory[talker.contact_id] = memory
-        print(self.user_memory)
+        async def remember_replies() -> None:
+            infos = await self.nlu_info(replies)
+            for i in range(len(replies)):
+                self.sessions.remember(session, '你', replies[i], infos[i], t)
+
+        await self.write_behind.submit(session.contact_id, remember_replies)
 
     async def on_message(self, msg: Message) -> None:
         talker = msg.talker()
@@ -470,15 +714,26 @@ class DramaPlugin(WechatyPlugin):
             return
 
         # 3. new-user register and old-user session load
-        if talker.contact_id not in self.users.keys():
-            self.users[talker.contact_id] = ['张无忌', 'welcome']
-            self.user_memory[talker.contact_id] = self.user_memory_template
-            self.last_turn_memory[talker.contact_id] = self.last_turn_memory_template
-            #实际上这里是用talker.contact_id充当"局"的概念，即同样的游戏可能同时开好几局，所有的背景记忆是一样的，但是用户相关的记忆是要分开的。
-            #因为这一次是单场景单角色，所以就相当于"一个用户是一句"了，所以用contact_id作为区分，假如是剧本啥这种，就可以用room_id
-            await talker.say("先声明哈，我们之间的对话信息可能会被公开，介意的话请终止对话！\n"
-                             "请您务必不要透露任何隐私信息，请您务发表不当言论")
-            return
+        session = self.sessions.get(talker.contact_id)
+        if session is None:
+            # new users wait behind the active sessions, and are turned away when the bot is overloaded
+            try:
+                async with self.admission.admit(NEW_USER):
+                    # a quick second message of the same new user may have waited for admission as well,
+                    # it goes on like a message of a known user
+                    session = self.sessions.get(talker.contact_id)
+                    if session is None:
+                        self.sessions.create(talker.contact_id, ['张无忌', 'welcome'])
+                        #实际上这里是用talker.contact_id充当"局"的概念，即同样的游戏可能同时开好几局，所有的背景记忆是一样的，但是用户相关的记忆是要分开的。
+                        #因为这一次是单场景单角色，所以就相当于"一个用户是一句"了，所以用contact_id作为区分，假如是剧本啥这种，就可以用room_id
+                        await talker.say("先声明哈，我们之间的对话信息可能会被公开，介意的话请终止对话！\n"
+                                         "请您务必不要透露任何隐私信息，请您务发表不当言论")
+            except Busy:
+                self.logger.warning(f'admission queue is full, registration of {talker.contact_id} is refused')
+                await talker.say(self.busy_reply)
+                return
+            if session is None:
+                return
 
         # 4. message pre-process
         """
@@ -496,16 +751,35 @@ class DramaPlugin(WechatyPlugin):
 
         text = text.strip().replace('\n', '，')
 
-        if self.gfw.filter(text):
-            self.logger.info(f'{text} is filtered, for the reason of {self.gfw.filter(text)}')
+        sensitive_word = self.gfw.filter(text)
+        if sensitive_word:
+            self.logger.info(f'{text} is filtered, for the reason of {sensitive_word}')
             await msg.say('请勿发表不当言论，谢谢配合')
             return
 
+        self.queue.submit(talker.contact_id, (talker, text))
+
+    async def _turn(self, contact_id: str, items: list) -> None:
+        """one turn of a contact, the texts sent in a quick burst are answered together"""
+        talker = items[-1][0]
+        # read-your-writes: the memory of the last replies must be in place before this turn reads it
+        await self.write_behind.barrier(contact_id)
+        session = self.sessions.get(contact_id)
+        priority = NEW_USER if session.scenario == 'welcome' else ACTIVE
+        try:
+            async with self.admission.admit(priority):
+                await self._act_turn(talker, session, items)
+        except Busy:
+            self.logger.warning(f'admission queue is full, turn of {contact_id} is refused')
+            await talker.say(self.busy_reply)
+
+    async def _act_turn(self, talker: Contact, session: Session, items: list) -> None:
+        text = '，'.join(text for _, text in items)
+
         # 5. check the status of the talker. for special status do the special action
-        scenario = self.users[talker.contact_id][1]
-        character = self.users[talker.contact_id][0]
-        memory = self.user_memory[talker.contact_id]
-        last_dialog = ''.join(self.last_turn_memory[talker.contact_id][scenario][character])
+        scenario = session.scenario
+        character = session.character
+        last_dialog = ''.join(session.last_turn[scenario][character])
         rules = self.scenarios[scenario][character] if character in self.scenarios[scenario].keys() else {'DESCRIPTION':''}
         self.temp_talker = talker
 
@@ -516,14 +790,14 @@ class DramaPlugin(WechatyPlugin):
         """
         if scenario == 'welcome':
             await talker.say("just the same as description in scenario yitiantulong")
-            self.users[talker.contact_id][1] = "yitiantulong"
+            self.sessions.set_status(session, character, "yitiantulong")
             return
 
-        self.last_turn_memory[talker.contact_id][scenario][character] = [f'{character}说：“{text}”']
+        session.last_turn[scenario][character] = [f'{character}说：“{text}”']
         if self.take_over is True:
             await self.take_over_director.say(f"{character} in the {scenario} just say: {text}. pls reply directly here")
             await self.take_over_director.say(f"last turn dialog: {last_dialog}")
         else:
-            await self.soul(text, talker, scenario, character, memory, last_dialog, rules)
+            await self.soul(text, talker, session, scenario, character, last_dialog, rules)
 
         # colorful eggs https://ai.baidu.com/ai-doc/wenxin/Zl33wtflg
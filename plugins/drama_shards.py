@@ -0,0 +1,382 @@
+"""
+multi-process mode of DramaPlugin
+the front plugin receives the wechaty messages and routes each one by consistent hash of the contact_id
+to one of N worker processes, every worker runs a full DramaPlugin(soul, sessions, journal) for its shard
+of the users. a user always lands on the same worker, so its session has a single owner and needs no locks.
+workers answer through proxy contacts/messages, the front relays their replies to wechaty.
+director commands that change or report state are broadcast to all the workers
+"""
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import wechaty
+from wechaty import (
+    Message,
+    WechatyPlugin,
+    WechatyPluginOptions
+)
+from wechaty_puppet import get_logger
+
+from utils.contact_queue import ContactQueue
+from utils.hash_ring import HashRing
+
+# director commands every worker has to see
+BROADCAST = ['ding', 'reload directors', 'reload mmrules', 'reload memory', 'reload scenarios', 'save', 'stats',
+             'take over', 'take over off']
+
+
+class ProxyContact():
+    """the part of wechaty.Contact DramaPlugin uses, say() is relayed by the front"""
+
+    def __init__(self, contact_id: str, name: str, outbox):
+        self.contact_id = contact_id
+        self.name = name
+        self._outbox = outbox
+
+    async def say(self, text: str) -> None:
+        self._outbox.put(('say', self.contact_id, text))
+
+
+class ProxyMessage():
+    """the part of wechaty.Message DramaPlugin uses"""
+
+    def __init__(self, message_id: str, talker: ProxyContact, message_type, text: str, outbox, prefix: str = ''):
+        self.message_id = message_id
+        self._talker = talker
+        self._type = message_type
+        self._text = text
+        self._outbox = outbox
+        self._prefix = prefix
+
+    def talker(self) -> ProxyContact:
+        return self._talker
+
+    def is_self(self) -> bool:
+        return False
+
+    def room(self) -> None:
+        return None
+
+    def type(self):
+        return self._type
+
+    def text(self) -> str:
+        return self._text
+
+    async def say(self, text: str) -> None:
+        await self._talker.say(self._prefix + text)
+
+    async def forward(self, contact: ProxyContact) -> None:
+        self._outbox.put(('forward', self.message_id, contact.contact_id))
+
+
+def _shard_main(shard: int, shards: int, plugin_kwargs: dict, inbox, outbox) -> None:
+    asyncio.run(_serve_shard(shard, shards, plugin_kwargs, inbox, outbox))
+
+
+async def _serve_shard(shard: int, shards: int, plugin_kwargs: dict, inbox, outbox) -> None:
+    from plugins.drama import DramaPlugin
+
+    try:
+        plugin = DramaPlugin(shard=shard, shards=shards, **plugin_kwargs)
+        await plugin.init_plugin(None)
+    except Exception as e:
+        outbox.put(('failed', shard, repr(e)))
+        return
+    outbox.put(('ready', shard, None))
+
+    loop = asyncio.get_running_loop()
+    # a thread of its own, so that a blocking get never waits behind other executor jobs
+    reader = ThreadPoolExecutor(max_workers=1)
+    tasks = set()
+    while True:
+        item = await loop.run_in_executor(reader, inbox.get)
+        if item is None:
+            break
+        seq, message_id, contact_id, name, message_type, text, prefix = item
+        # the front re-routes the messages not taken yet when this worker dies
+        outbox.put(('taken', shard, seq))
+        msg = ProxyMessage(message_id, ProxyContact(contact_id, name, outbox), message_type, text, outbox, prefix)
+        # like wechaty, messages are handled concurrently, the turns of a contact are ordered by its ContactQueue
+        task = asyncio.create_task(plugin.on_message(msg))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await plugin.close()
+    reader.shutdown(wait=False)
+    outbox.put(('closed', shard, None))
+
+
+class ShardedDramaPlugin(WechatyPlugin):
+    """front of N DramaPlugin worker processes"""
+
+    def __init__(self,
+                 options: Optional[WechatyPluginOptions] = None,
+                 shards: Optional[int] = None,
+                 configs: str = 'drama_configs',
+                 replicas: int = 160,
+                 check_interval: float = 5,
+                 start_timeout: float = 600,
+                 max_reroutes: int = 1,
+                 **plugin_kwargs) -> None:
+        super().__init__(options)
+        self.shards = shards or os.cpu_count() or 1
+        self.config_url = configs
+        self.plugin_kwargs = dict(plugin_kwargs, configs=configs)
+        self.ring = HashRing(range(self.shards), replicas)
+        self.check_interval = check_interval
+        self.start_timeout = start_timeout
+        self.max_reroutes = max_reroutes
+
+        self.cache_dir = f'./.{self.name}'
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.logger = get_logger(self.name, os.path.join(self.cache_dir, 'log.log'))
+
+        with open(os.path.join(self.config_url, 'directors.json'), 'r', encoding='utf-8') as f:
+            self.directors = json.load(f)
+
+        self._ctx = multiprocessing.get_context('spawn')
+        # every worker has its own queues, made anew when it is restarted
+        self._inboxes = [None] * self.shards
+        self._outboxes = [None] * self.shards
+        self._processes = [None] * self.shards
+        # seq -> [item, reroutes] of the messages routed to a shard and not taken by its worker yet
+        self._pending = [OrderedDict() for _ in range(self.shards)]
+        self._seq = itertools.count()
+        self._ready = None
+        self._failed = {}
+        self._closed = None
+        self._started = None
+        self._start_error = None
+        self._closing = False
+        self._tasks = []
+        self._replies = None
+
+        # contacts seen on incoming messages, replies are sent through them
+        self._contacts = OrderedDict()
+        self._contacts_cap = 10000
+        # director messages a worker may ask to forward during a take over
+        self._director_messages = OrderedDict()
+        self._last_shard = 0
+        self.take_over = False
+        self.routed = [0] * self.shards
+
+    async def init_plugin(self, wechaty: wechaty.Wechaty) -> None:
+        await super().init_plugin(wechaty)
+        self._ready = [asyncio.Event() for _ in range(self.shards)]
+        self._closed = [asyncio.Event() for _ in range(self.shards)]
+        self._started = asyncio.Event()
+        self._replies = ContactQueue(self._send, debounce=0, max_delay=0, logger=self.logger)
+        try:
+            await self._start()
+        except RuntimeError as e:
+            self._start_error = e
+            self._abort()
+            raise
+        finally:
+            self._started.set()
+        self._tasks.append(asyncio.create_task(self._watch()))
+
+    def _spawn(self, shard: int) -> None:
+        """
+        start the worker of a shard with new queues, a dead worker may still hold the lock of its old ones.
+        not daemonic, a worker with uie_workers starts processes of its own
+        """
+        self._renew_inbox(shard)
+        # the relay of the old outbox reads what is left in it and stops
+        outbox = self._outboxes[shard] = self._ctx.Queue()
+        self._tasks.append(asyncio.create_task(self._relay(shard, outbox)))
+
+        process = self._ctx.Process(target=_shard_main, name=f'drama-shard-{shard}',
+                                    args=(shard, self.shards, self.plugin_kwargs, self._inboxes[shard], outbox))
+        process.start()
+        self._processes[shard] = process
+
+    def _renew_inbox(self, shard: int) -> None:
+        """a new inbox with the messages the previous worker had not taken"""
+        inbox = self._inboxes[shard]
+        self._inboxes[shard] = self._ctx.Queue()
+        if inbox is None:
+            return
+        inbox.cancel_join_thread()
+        inbox.close()
+        # a worker that crashed on a message may not have sent 'taken' for it. the oldest message is the
+        # suspect, it is dropped after max_reroutes instead of crashing every new worker
+        for i, (seq, pending) in enumerate(list(self._pending[shard].items())):
+            if i == 0 and pending[1] >= self.max_reroutes:
+                del self._pending[shard][seq]
+                self.logger.error(f'drama shard {shard} dropped message {pending[0][1]} after {pending[1]} re-routes')
+                continue
+            if i == 0:
+                pending[1] += 1
+            self._inboxes[shard].put(pending[0])
+        if self._pending[shard]:
+            self.logger.warning(f'{len(self._pending[shard])} messages re-routed to the new drama shard {shard}')
+
+    async def _start(self) -> None:
+        """
+        shard 0 starts first and warms the shared files(static/int8 model, memory.txt extraction cache),
+        messages are routed once every shard has replayed its journals
+        """
+        deadline = asyncio.get_running_loop().time() + self.start_timeout
+        self._spawn(0)
+        await self._wait_ready([0], deadline)
+        for shard in range(1, self.shards):
+            self._spawn(shard)
+        await self._wait_ready(range(1, self.shards), deadline)
+        self.logger.info(f'{self.shards} drama shards started')
+
+    async def _wait_ready(self, shards, deadline: float) -> None:
+        loop = asyncio.get_running_loop()
+        while not all(self._ready[shard].is_set() for shard in shards):
+            if self._failed:
+                raise RuntimeError(f'drama shard failed to start: {self._failed}')
+            if any(not self._processes[shard].is_alive() and not self._ready[shard].is_set() for shard in shards):
+                raise RuntimeError('drama shard exited while starting')
+            if loop.time() > deadline:
+                raise RuntimeError('drama shards did not get ready in time')
+            await asyncio.sleep(0.1)
+
+    def _abort(self) -> None:
+        """stop the workers and the relays after a failed start"""
+        self._closing = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.kill()
+                process.join()
+        for task in self._tasks:
+            task.cancel()
+
+    async def _watch(self) -> None:
+        """restart dead workers, their users' state is in users.db and their journal"""
+        while not self._closing:
+            await asyncio.sleep(self.check_interval)
+            for shard, process in enumerate(self._processes):
+                if not self._closing and process is not None and not process.is_alive():
+                    self.logger.error(f'drama shard {shard} exited with {process.exitcode}, restarting')
+                    self._ready[shard].clear()
+                    self._spawn(shard)
+
+    async def _relay(self, shard: int, outbox) -> None:
+        """replies and events of one worker, till it closed or its outbox was replaced on a restart"""
+        loop = asyncio.get_running_loop()
+        reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            while not self._closed[shard].is_set():
+                try:
+                    item = await loop.run_in_executor(reader, outbox.get, True, self.check_interval)
+                except queue.Empty:
+                    if self._outboxes[shard] is not outbox:
+                        return
+                    continue
+                await self._handle(*item)
+        finally:
+            reader.shutdown(wait=False)
+
+    async def _handle(self, kind: str, key, value) -> None:
+        if kind == 'say':
+            self._replies.submit(key, value)
+        elif kind == 'forward':
+            msg = self._director_messages.get(key)
+            if msg is not None:
+                await msg.forward(self._contact(value))
+        elif kind == 'taken':
+            self._pending[key].pop(value, None)
+        elif kind == 'ready':
+            self._ready[key].set()
+        elif kind == 'failed':
+            if not self._started.is_set():
+                self._failed[key] = value
+            self.logger.error(f'drama shard {key} failed to start: {value}')
+        elif kind == 'closed':
+            self._closed[key].set()
+            self.logger.info(f'drama shard {key} closed')
+
+    def _contact(self, contact_id: str):
+        contact = self._contacts.get(contact_id)
+        if contact is None:
+            contact = self.bot.Contact.load(contact_id)
+        return contact
+
+    async def _send(self, contact_id: str, texts: list) -> None:
+        """the replies of a contact in order, different contacts in parallel"""
+        contact = self._contact(contact_id)
+        for text in texts:
+            await contact.say(text)
+
+    def _remember_contact(self, contact) -> None:
+        self._contacts[contact.contact_id] = contact
+        self._contacts.move_to_end(contact.contact_id)
+        while len(self._contacts) > self._contacts_cap:
+            self._contacts.popitem(last=False)
+
+    def _route(self, shard: int, msg: Message, prefix: str = '') -> None:
+        talker = msg.talker()
+        seq = next(self._seq)
+        item = (seq, msg.message_id, talker.contact_id, talker.name, msg.type(), msg.text(), prefix)
+        self._pending[shard][seq] = [item, 0]
+        self._inboxes[shard].put(item)
+        self.routed[shard] += 1
+
+    async def on_message(self, msg: Message) -> None:
+        talker = msg.talker()
+        if talker.contact_id == msg.is_self() or talker.contact_id == "weixin" or msg.room():
+            return
+        await self._started.wait()
+        if self._start_error is not None:
+            raise self._start_error
+        self._remember_contact(talker)
+
+        if talker.contact_id not in self.directors:
+            self._last_shard = self.ring.node(talker.contact_id)
+            self._route(self._last_shard, msg)
+            return
+
+        text = msg.text()
+        if text == 'reload directors':
+            with open(os.path.join(self.config_url, 'directors.json'), 'r', encoding='utf-8') as f:
+                directors = json.load(f)
+            if len(directors) > 0:
+                self.directors = directors
+        if text in ['take over', 'take over off']:
+            self.take_over = text == 'take over'
+
+        if text in BROADCAST:
+            for shard in range(self.shards):
+                self._route(shard, msg, f'[shard {shard}] ')
+            if text == 'stats':
+                await msg.say(f'routed messages per shard: {self.routed}')
+        elif text == 'help':
+            self._route(0, msg)
+        else:
+            # during a take over the director talks to the user of the last message
+            self._director_messages[msg.message_id] = msg
+            while len(self._director_messages) > 100:
+                self._director_messages.popitem(last=False)
+            self._route(self._last_shard if self.take_over else 0, msg)
+
+    async def close(self) -> None:
+        """let every worker finish its turns and save, then stop the relays"""
+        self._closing = True
+        alive = [shard for shard, process in enumerate(self._processes) if process is not None and process.is_alive()]
+        for shard in alive:
+            self._inboxes[shard].put(None)
+        # 'closed' is the last thing a worker sends, all its replies are relayed before it
+        for shard in alive:
+            await self._closed[shard].wait()
+        loop = asyncio.get_running_loop()
+        for shard in alive:
+            await loop.run_in_executor(None, self._processes[shard].join)
+        if self._replies is not None:
+            await self._replies.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
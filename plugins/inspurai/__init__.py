@@ -1,10 +1,12 @@
 import sys
 import os
 from .inspurai import Example, Yuan
+from .prompt_cache import PromptCache
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
 __all__ = [
     Example,
     Yuan,
+    PromptCache,
 ]
@@ -3,8 +3,11 @@
 # import time
 # import json
 import os
+import time
 import uuid
-from plugins.inspurai.url_config import submit_request, reply_request
+import asyncio
+import aiohttp
+from plugins.inspurai.url_config import submit_request, reply_request, async_submit_request, async_reply_request
 
 def set_yuan_account(user, phone):
     os.environ['YUAN_ACCOUNT'] = user + '||' + phone
@@ -51,7 +54,12 @@ class Yuan:
                 output_suffix='\n\n',
                 append_output_prefix_to_query=False,
                 topK=1,
-                topP=0.9):
+                topP=0.9,
+                timeout=20,
+                pool_size=16,
+                cache=None,
+                cache_sampled=False,
+                breaker=None):
         
         self.examples = {}
         self.engine = engine
@@ -65,6 +73,15 @@ class Yuan:
         self.output_suffix = output_suffix
         self.append_output_prefix_to_query = append_output_prefix_to_query
         self.stop = (output_suffix + input_prefix).strip()
+        # overall deadline(seconds) of one async generation, submit + polling
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        # optional PromptCache, by default only deterministic(topK=1) generations are cached
+        self.cache = cache
+        self.cache_sampled = cache_sampled
+        # optional utils.circuit_breaker.CircuitBreaker, cached replies are still served while it is open
+        self.breaker = breaker
 
         if self.engine not in ['base_10B','translate','dialog']:
             raise Exception('engine must be one of [\'base_10B\',\'translate\',\'dialog\'] ')
@@ -128,13 +145,27 @@ class Yuan:
                 topP=0.9,
                 topK=7):
         """Obtains the original result returned by the API."""
+        key = self._cache_key(query, engine, max_tokens, temperature, topP, topK)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return {'resData': cached}
 
+        if self.breaker is not None:
+            self.breaker.check()
+        start = time.monotonic()
         try:
             requestId = submit_request(query,temperature,topP,topK,max_tokens, engine)
             response_text = reply_request(requestId)
         except Exception as e:
+            if self.breaker is not None:
+                self.breaker.record(False)
             raise e
-        
+        if self.breaker is not None:
+            self.breaker.record(bool(response_text), time.monotonic() - start)
+
+        if key is not None and response_text:
+            self.cache.set(key, response_text['resData'])
         return response_text
 
 
@@ -145,6 +176,79 @@ class Yuan:
         return msg
 
 
+    def _cache_key(self, query, engine, max_tokens, temperature, topP, topK):
+        """None if this generation should not be cached"""
+        if self.cache is None or (topK != 1 and not self.cache_sampled):
+            return None
+        return self.cache.make_key(query, engine, temperature, topK, topP, max_tokens)
+
+    def _get_session(self):
+        """keep-alive session of the async api, created inside the running loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def aresponse(self,
+                        query,
+                        engine='',
+                        max_tokens=20,
+                        temperature=0.3,
+                        topP=0.9,
+                        topK=7,
+                        timeout=None):
+        """Obtains the original result returned by the API without blocking the event loop.
+        Returns None if submit + polling exceed the timeout, cancelling the caller cancels the polling.
+        Raises CircuitOpenError without calling the API while the breaker is open."""
+        key = self._cache_key(query, engine, max_tokens, temperature, topP, topK)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return {'resData': cached}
+
+        if self.breaker is not None:
+            self.breaker.check()
+        session = self._get_session()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + (timeout or self.timeout)
+        try:
+            requestId = await async_submit_request(session, query, temperature, topP, topK, max_tokens, engine,
+                                                   timeout=deadline - loop.time())
+            response_text = await async_reply_request(session, requestId, deadline)
+        except asyncio.CancelledError:
+            if self.breaker is not None:
+                self.breaker.release()
+            raise
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            response_text = None
+        except Exception:
+            if self.breaker is not None:
+                self.breaker.record(False)
+            raise
+        if self.breaker is not None:
+            self.breaker.record(bool(response_text), loop.time() - start)
+        if not response_text:
+            return None
+
+        if key is not None:
+            self.cache.set(key, response_text['resData'])
+        return response_text
+
+    async def asubmit_API(self, prompt, trun='▃', timeout=None):
+        """async version of submit_API, the whole generation is bounded by timeout(default self.timeout)."""
+        query = self.craft_query(prompt)
+        res = await self.aresponse(query,engine=self.engine,
+                                   max_tokens=self.max_tokens,
+                                   temperature=self.temperature,
+                                   topP=self.topP,
+                                   topK=self.topK,
+                                   timeout=timeout)
+        return self.postprocess(res, trun)
+
     def submit_API(self, prompt, trun='▃'):
         """Submit prompt to yuan API interface and obtain an pure text reply.
         :prompt: Question or any content a user may input.
@@ -155,6 +259,10 @@ class Yuan:
                             temperature=self.temperature,
                             topP=self.topP,
                             topK=self.topK)
+        return self.postprocess(res, trun)
+
+    def postprocess(self, res, trun='▃'):
+        """Turn the raw API result into pure text."""
         txt = res['resData'] if res else "something went wrong with yuan service"
         # 单独针对翻译模型的后处理
         if self.engine == 'translate':
@@ -0,0 +1,101 @@
+"""
+response cache of the Yuan API
+keyed on the crafted query and the sampling parameters, an LRU with ttl in memory,
+backed by a sqlite file so that the cache survives restarts.
+new rows are committed in batches of flush_size, expired rows and rows over disk_maxsize
+are pruned every prune_interval inserts and on close()
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Optional
+
+from utils.lru_cache import TTLCache
+
+
+class PromptCache:
+    """store the raw resData of a generation"""
+
+    def __init__(self, path: Optional[str] = None, maxsize=1024, ttl=86400, disk_maxsize=100000,
+                 flush_size=32, prune_interval=1000):
+        self.memory = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.disk_maxsize = disk_maxsize
+        self.flush_size = flush_size
+        self.prune_interval = prune_interval
+        self.disk_hits = 0
+        # key -> (value, created), rows not committed yet
+        self._pending = {}
+        self._inserts = 0
+        self.db = None
+        if path:
+            # shards of a multi-process run share the file, WAL lets their reads and writes overlap
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS prompts (key TEXT PRIMARY KEY, value TEXT, created REAL)')
+            self._evict()
+
+    @staticmethod
+    def make_key(query, engine, temperature, topK, topP, max_tokens):
+        raw = json.dumps([query, engine, temperature, topK, topP, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _evict(self):
+        """drop expired rows and keep at most disk_maxsize of the newest"""
+        with self.db:
+            if self.ttl is not None:
+                self.db.execute('DELETE FROM prompts WHERE created < ?', (time.time() - self.ttl,))
+            self.db.execute('DELETE FROM prompts WHERE key NOT IN '
+                            '(SELECT key FROM prompts ORDER BY created DESC LIMIT ?)', (self.disk_maxsize,))
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.db is None:
+            return value
+
+        row = self._pending.get(key)
+        if row is None:
+            row = self.db.execute('SELECT value, created FROM prompts WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl is not None and row[1] < time.time() - self.ttl):
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, row[0])
+        return row[0]
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.db is None:
+            return
+        self._pending[key] = (value, time.time())
+        self._inserts += 1
+        try:
+            if len(self._pending) >= self.flush_size:
+                self.flush()
+            if self._inserts >= self.prune_interval:
+                self._inserts = 0
+                self._evict()
+        except sqlite3.OperationalError:
+            # the file is busy with another shard, the rows stay pending till the next flush
+            pass
+
+    def flush(self):
+        """commit the pending rows in one transaction"""
+        if self.db is None or not self._pending:
+            return
+        rows = [(key, value, created) for key, (value, created) in self._pending.items()]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO prompts VALUES (?, ?, ?)', rows)
+        self._pending.clear()
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self._evict()
+            self.db.close()
+            self.db = None
@@ -3,6 +3,9 @@ import hashlib
 import time
 import json
 import os
+import asyncio
+
+import aiohttp
 
 ACCOUNT = ''
 PHONE = ''
@@ -13,6 +16,9 @@ PHONE = ''
 SUBMIT_URL = "http://api-air.inspur.com:32102/v1/interface/api/infer/getRequestId?"
 REPLY_URL = "http://api-air.inspur.com:32102/v1/interface/api/result?"
 
+# keep-alive connections for the blocking api
+SESSION = requests.Session()
+
 def code_md5(str):
     code=str.encode("utf-8")
     m = hashlib.md5()
@@ -23,7 +29,7 @@ def code_md5(str):
 def rest_get(url, header,timeout, show_error=False):
     '''Call rest get method'''
     try:
-        response = requests.get(url, headers=header,timeout=timeout, verify=False)
+        response = SESSION.get(url, headers=header,timeout=timeout, verify=False)
         return response
     except Exception as exception:
         if show_error:
@@ -39,11 +45,14 @@ def header_generation():
     headers = {'token': token}
     return headers
 
+def submit_url(query,temperature,topP,topK,max_tokens,engine):
+    return SUBMIT_URL + "engine={0}&account={1}&data={2}&temperature={3}&topP={4}&topK={5}&tokensToGenerate={6}" \
+                        "&type={7}".format(engine,ACCOUNT,query,temperature,topP,topK, max_tokens,"api")
+
 def submit_request(query,temperature,topP,topK,max_tokens,engine):
     """Submit query to the backend server and get requestID."""
     headers=header_generation()
-    url=SUBMIT_URL + "engine={0}&account={1}&data={2}&temperature={3}&topP={4}&topK={5}&tokensToGenerate={6}" \
-                     "&type={7}".format(engine,ACCOUNT,query,temperature,topP,topK, max_tokens,"api")
+    url=submit_url(query,temperature,topP,topK,max_tokens,engine)
 
     response=rest_get(url,headers,30)
     response_text = json.loads(response.text)
@@ -65,3 +74,40 @@ def reply_request(requestId,cycle_count=5):
         if response_text["flag"] == False and i == cycle_count-1:
             raise RuntimeWarning(response_text)
         time.sleep(3)
+
+async def async_rest_get(session, url, header, timeout):
+    '''Call rest get method on an aiohttp session, return the parsed json'''
+    async with session.get(url, headers=header, timeout=aiohttp.ClientTimeout(total=timeout), ssl=False) as response:
+        return json.loads(await response.text())
+
+async def async_submit_request(session,query,temperature,topP,topK,max_tokens,engine,timeout=30):
+    """Submit query to the backend server and get requestID, without blocking the event loop."""
+    headers=header_generation()
+    url=submit_url(query,temperature,topP,topK,max_tokens,engine)
+    response_text = await async_rest_get(session, url, headers, timeout)
+    if response_text["flag"]:
+        return response_text["resData"]
+    raise RuntimeWarning(response_text)
+
+async def async_reply_request(session,requestId,deadline,first_delay=0.5,max_delay=3,backoff=1.5):
+    """
+    Poll the reply API till the response is ready or the deadline(loop time) is reached.
+    The delay between polls grows from first_delay to max_delay.
+    Returns None on deadline, raises if the last poll before the deadline was refused.
+    """
+    loop = asyncio.get_running_loop()
+    url = REPLY_URL + "account={0}&requestId={1}".format(ACCOUNT, requestId)
+    headers = header_generation()
+    delay = first_delay
+    response_text = None
+    while True:
+        await asyncio.sleep(max(min(delay, deadline - loop.time()), 0))
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            if response_text is not None and response_text["flag"] == False:
+                raise RuntimeWarning(response_text)
+            return None
+        response_text = await async_rest_get(session, url, headers, remaining)
+        if response_text["resData"] != None:
+            return response_text
+        delay = min(delay * backoff, max_delay)
@@ -2,15 +2,31 @@ import asyncio
 import os
 
 from wechaty import Wechaty, WechatyOptions
-from plugins.drama import DramaPlugin
 
 
-if __name__ == "__main__":
+async def main():
     options = WechatyOptions(
         port=int(os.environ.get('PORT', 8004)),
     )
     bot = Wechaty(options)
+    # DRAMA_SHARDS=N runs the conversations on N worker processes
+    shards = int(os.environ.get('DRAMA_SHARDS', 1))
+    if shards > 1:
+        # the front process does not load the models
+        from plugins.drama_shards import ShardedDramaPlugin
+        drama = ShardedDramaPlugin(shards=shards)
+    else:
+        from plugins.drama import DramaPlugin
+        drama = DramaPlugin()
     bot.use([
-        DramaPlugin(),
+        drama,
     ])
-    asyncio.run(bot.start())
+    try:
+        await bot.start()
+    finally:
+        # the memory writes still queued are flushed before exit
+        await drama.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,21 +5,144 @@ https://github.com/guojia60180/sensitive-words-filter
 增加了测试代码，来自https://blog.csdn.net/u013421629/article/details/83178970
 更改了返回模式，返回是否检测到和检测到的敏感词(检测到第一个敏感词就返回）
 关键词数据来自：https://github.com/fwwdn/sensitive-stop-words
+增加了Aho-Corasick模式（默认），带失败指针，单次线性扫描即可找出全部命中
+注意：ac模式只命中连续出现的关键词，原dfa模式在关键词字符之间夹有其他字符时也会命中
+（如"推一下这个方案，加点油"在dfa模式下命中"推油"），这类跨字误报在ac模式下不再出现，
+是有意的审核口径变化；需要原行为时用DFAFilter(mode='dfa')
+增加了预编译的自动机文件（扁平数组表），通过mmap加载，多个worker进程共享同一份内存页
+增加了批量检测接口filter_many，一次扫描返回每条文本的命中词及位置
 '''
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+# header: magic, byte order, sha256 of the keywords file, node count, edge count
+_MAGIC = b'AWDFAAC1'
+_HEADER = struct.Struct('<8s8s32sII')
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def compile_keywords(path="./utils/keywords", out_path=None):
+    """
+    compile the keywords file into a flat, array-backed Aho-Corasick automaton file.
+    layout after the header (all uint32, native byte order):
+    offsets[n_nodes+1], edge_chars[n_edges], edge_targets[n_edges], fail[n_nodes], out[n_nodes], link[n_nodes]
+    the edges of node k are edge_chars[offsets[k]:offsets[k+1]], sorted by code point
+    """
+    out_path = out_path or path + '.ac'
+    trie = DFAFilter()
+    with open(path, encoding='utf-8') as f:
+        for keyword in f:
+            trie.add(keyword.strip())
+    trie._build()
+
+    offsets, chars, targets = array('I', [0]), array('I'), array('I')
+    for edges in trie._goto:
+        for char, nxt in sorted(edges.items(), key=lambda e: ord(e[0])):
+            chars.append(ord(char))
+            targets.append(nxt)
+        offsets.append(len(chars))
+
+    header = _HEADER.pack(_MAGIC, sys.byteorder.encode().ljust(8, b'\x00'), _file_digest(path),
+                          len(trie._goto), len(chars))
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for table in [offsets, chars, targets, array('I', trie._fail), array('I', trie._out), array('I', trie._link)]:
+            table.tofile(f)
+    # atomic, so workers which already mapped the old file are not affected
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class _MappedAutomaton():
+    '''read-only automaton backed by a compiled file, loaded via mmap'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, self.digest, n_nodes, n_edges = _HEADER.unpack_from(self._mm)
+        sizes = [n_nodes + 1, n_edges, n_edges, n_nodes, n_nodes, n_nodes]
+        if magic != _MAGIC or byteorder.rstrip(b'\x00') != sys.byteorder.encode() \
+                or len(self._mm) != _HEADER.size + 4 * sum(sizes):
+            self._mm.close()
+            raise ValueError(f'{path} is not a valid compiled keywords file for this platform')
+
+        tables = memoryview(self._mm)[_HEADER.size:].cast('I')
+        views = []
+        start = 0
+        for size in sizes:
+            views.append(tables[start:start + size])
+            start += size
+        self._offsets, self._chars, self._targets, self._fail, self._out, self._link = views
+        # most chars of a normal message fall back to the root, keep its edges in a small dict
+        self._root = {self._chars[j]: self._targets[j] for j in range(self._offsets[0], self._offsets[1])}
+
+    def scan(self, message):
+        """yield (offset, word) of every hit, message must be lower case already"""
+        offsets, chars, targets = self._offsets, self._chars, self._targets
+        fail, out, link, root = self._fail, self._out, self._link, self._root
+        node = 0
+        for i, char in enumerate(message):
+            c = ord(char)
+            while node:
+                lo, hi = offsets[node], offsets[node + 1]
+                j = bisect_left(chars, c, lo, hi)
+                if j < hi and chars[j] == c:
+                    node = targets[j]
+                    break
+                node = fail[node]
+            else:
+                node = root.get(c, 0)
+            hit = node if out[node] else link[node]
+            while hit:
+                start = i + 1 - out[hit]
+                yield start, message[start:i + 1]
+                hit = link[hit]
+
 
 class DFAFilter():
     '''有穷状态机完成'''
 
-    def __init__(self):
+    def __init__(self, mode='ac'):
+        if mode not in ['ac', 'dfa']:
+            raise ValueError("mode must be one of ['ac', 'dfa']")
+        self.mode = mode
         self.keywords_chains={}
         self.delimit='\x00'
 
+        # Aho-Corasick tables, node 0 is the root
+        # _goto: transitions, _fail: failure links,
+        # _out: length of the keyword ending at the node (0 if none),
+        # _link: nearest node on the failure chain that ends a keyword
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [0]
+        self._link = [0]
+        self._built = True
+        # compiled automata loaded by parse()
+        self._mapped = []
+
     def add(self, keyword):
         keyword=keyword.lower()
         chars=keyword.strip()
         if not chars:
             return
 
+        if self.mode == 'ac':
+            self._add_ac(chars)
+            return
+
         level = self.keywords_chains
         for i in range(len(chars)):
             if chars[i] in level:
@@ -40,12 +163,139 @@ class DFAFilter():
         if i == len(chars)-1:
             level[self.delimit]=0
 
-    def parse(self, path="./utils/keywords"):
+    def _add_ac(self, chars):
+        node = 0
+        for char in chars:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(0)
+                self._link.append(0)
+            node = nxt
+        self._out[node] = len(chars)
+        self._built = False
+
+    def _build(self):
+        """compute the failure links breadth-first"""
+        goto, fail, out, link = self._goto, self._fail, self._out, self._link
+        queue = deque()
+        for nxt in goto[0].values():
+            fail[nxt] = 0
+            link[nxt] = 0
+            queue.append(nxt)
+
+        while queue:
+            node = queue.popleft()
+            for char, nxt in goto[node].items():
+                f = fail[node]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(char, 0)
+                fail[nxt] = f
+                link[nxt] = f if out[f] else link[f]
+                queue.append(nxt)
+
+        self._built = True
+
+    def parse(self, path="./utils/keywords", compiled=True, compiled_path=None):
+        """
+        in ac mode the keywords are loaded from the compiled automaton file (default <path>.ac),
+        which is rebuilt when the hash of the keywords file changes. compiled=False keeps the old in-memory trie
+        """
+        if self.mode == 'ac' and compiled:
+            compiled_path = compiled_path or path + '.ac'
+            automaton = None
+            if os.path.exists(compiled_path):
+                try:
+                    automaton = _MappedAutomaton(compiled_path)
+                except (ValueError, struct.error):
+                    automaton = None
+            if automaton is None or automaton.digest != _file_digest(path):
+                automaton = _MappedAutomaton(compile_keywords(path, compiled_path))
+            self._mapped.append(automaton)
+            return
+
         with open(path, encoding='utf-8') as f:
             for keyword in f:
                 self.add(keyword.strip())
 
+    def iter_hits(self, message):
+        """
+        yield (offset, word) for every keyword occurrence in message, in order of the end offset.
+        only available in ac mode, the message is scanned exactly once per automaton
+        """
+        if self.mode != 'ac':
+            raise RuntimeError('iter_hits is only available in ac mode')
+
+        message = message.lower()
+        scans = [automaton.scan(message) for automaton in self._mapped]
+        if len(self._goto) > 1:
+            scans.append(self._scan(message))
+
+        if len(scans) == 1:
+            yield from scans[0]
+        elif scans:
+            yield from heapq.merge(*scans, key=lambda hit: hit[0] + len(hit[1]))
+
+    def _scan(self, message):
+        if not self._built:
+            self._build()
+
+        goto, fail, out, link = self._goto, self._fail, self._out, self._link
+        node = 0
+        for i, char in enumerate(message):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            hit = node if out[node] else link[node]
+            while hit:
+                start = i + 1 - out[hit]
+                yield start, message[start:i + 1]
+                hit = link[hit]
+
+    def filter_all(self, message):
+        """return all the hits as a list of (offset, word)"""
+        if self.mode == 'ac':
+            return list(self.iter_hits(message))
+
+        word = self.filter(message)
+        return [(message.lower().find(word), word)] if word else []
+
+    def filter_many(self, texts):
+        """
+        screen a batch of texts in one call, return a list of [(offset, word), ...] per text.
+        the texts are joined by the delimit char (never part of a keyword) and scanned once in ac mode
+        """
+        if self.mode != 'ac':
+            return [self.filter_all(text) for text in texts]
+
+        texts = [text.lower() for text in texts]
+        starts = []
+        pos = 0
+        for text in texts:
+            starts.append(pos)
+            pos += len(text) + 1
+
+        results = [[] for _ in texts]
+        for offset, word in self.iter_hits(self.delimit.join(texts)):
+            k = bisect_right(starts, offset) - 1
+            results[k].append((offset - starts[k], word))
+        return results
+
     def filter(self, message):
+        """
+        first sensitive word of message or None.
+        'ac' matches contiguous keywords only, 'dfa' keeps the original walk that also matches
+        keyword characters with other characters in between
+        """
+        if self.mode == 'ac':
+            for _, word in self.iter_hits(message):
+                return word
+            return None
+
         message = message.lower()
         start = 0
         while start < len(message):
@@ -64,6 +314,11 @@ class DFAFilter():
 
 
 if __name__ == "__main__":
+    # python -m utils.DFAFilter build [keywords_path]  预编译关键词自动机
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        print("compiled to:", compile_keywords(*sys.argv[2:3]))
+        sys.exit(0)
+
     import time
     time1 = time.time()
     gfw = DFAFilter()
@@ -0,0 +1,92 @@
+"""
+admission control and backpressure for the conversation pipeline
+at most max_active turns run at once, up to max_waiting more wait in a priority queue
+(active sessions before new users), anything beyond that is rejected at once with Busy
+so the caller can answer "busy" instead of piling up work. every stage of a turn(intent,
+extraction, generation) has its own concurrency limit on top of that
+"""
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+# priorities, the lower the earlier
+ACTIVE = 0
+NEW_USER = 1
+
+
+class Busy(Exception):
+    """the wait queue is full"""
+
+
+class AdmissionController():
+
+    def __init__(self, max_active: int = 32, max_waiting: int = 64, stage_limits: Optional[Dict[str, int]] = None):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.stage_limits = stage_limits or {}
+        self.active = 0
+        self.rejected = 0
+        self.admitted = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        # created lazily inside the running loop
+        self._stages: Dict[str, asyncio.Semaphore] = {}
+
+    @asynccontextmanager
+    async def admit(self, priority: int = ACTIVE):
+        """run the block as one admitted turn, raises Busy right away if the wait queue is full"""
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+        elif len(self._waiters) >= self.max_waiting:
+            self.rejected += 1
+            raise Busy()
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = [priority, next(self._seq), future]
+            heapq.heappush(self._waiters, entry)
+            try:
+                # the releasing turn hands its slot over, active is not decremented in between
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                else:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def stage(self, name: str):
+        """limit the concurrency of one pipeline stage, stages without a limit are not limited"""
+        limit = self.stage_limits.get(name)
+        if not limit:
+            yield
+            return
+        if name not in self._stages:
+            self._stages[name] = asyncio.Semaphore(limit)
+        async with self._stages[name]:
+            yield
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'waiting': len(self._waiters),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,89 @@
+"""
+micro-batching of blocking model calls
+requests of concurrent conversations are collected for a short window (or until max_batch_size),
+then run as one batch call on a worker thread, every caller gets its own result back
+"""
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+
+class MicroBatcher():
+    """func takes a list of items and returns a list of results in the same order"""
+
+    def __init__(self,
+                 func: Callable[[list], list],
+                 max_batch_size: int = 16,
+                 max_wait: float = 0.01,
+                 executor: Optional[Executor] = None):
+        if max_batch_size <= 0:
+            raise ValueError('max_batch_size must be positive')
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # paddle predictors are not thread-safe, one worker thread by default
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='batcher')
+
+        self.batches = 0
+        self.items = 0
+        self._pending = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, item):
+        results = await self.submit_many([item])
+        return results[0]
+
+    async def submit_many(self, items: list) -> list:
+        """queue the items together and wait for all of their results"""
+        if not items:
+            return []
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+        self._pending.extend(zip(items, futures))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush(full_only=True)
+        else:
+            self._schedule(loop)
+        return list(await asyncio.gather(*futures))
+
+    def _schedule(self, loop) -> None:
+        if self._pending and self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._flush()
+
+    def _flush(self, full_only: bool = False) -> None:
+        """start the pending batches, the rest of a partial batch keeps waiting if full_only"""
+        while self._pending and (len(self._pending) >= self.max_batch_size or not full_only):
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            asyncio.ensure_future(self._run(batch))
+        self._schedule(asyncio.get_running_loop())
+
+    async def _run(self, batch: list) -> None:
+        items = [item for item, _ in batch]
+        self.batches += 1
+        self.items += len(items)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.func, items)
+            if len(results) != len(items):
+                raise RuntimeError(f'batch function returned {len(results)} results for {len(items)} items')
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch_size': self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,98 @@
+"""
+circuit breaker for remote services
+closed: calls pass, failures and slow calls of the last `window` calls are tracked
+open: the failure rate exceeded the threshold, calls fail fast for open_duration seconds
+half_open: a limited number of probe calls decide whether to close or to open again
+"""
+import time
+from collections import deque
+
+
+class CircuitOpenError(RuntimeError):
+    """raised instead of calling the service while the circuit is open"""
+
+
+class CircuitBreaker():
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self,
+                 name: str = 'service',
+                 failure_rate: float = 0.5,
+                 min_calls: int = 5,
+                 window: int = 20,
+                 slow_call: float = 10,
+                 open_duration: float = 30,
+                 half_open_calls: int = 1,
+                 timer=time.monotonic):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_call = slow_call
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self.timer = timer
+
+        self._state = self.CLOSED
+        self._results = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self.timer() - self._opened_at >= self.open_duration:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """whether a call may go to the service now, a half-open probe slot is taken if so"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._probes < self.half_open_calls:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError(f'{self.name} circuit is open')
+
+    def release(self) -> None:
+        """give back a half-open probe slot of a call that was cancelled before it finished"""
+        if self._state == self.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record(self, success: bool, latency: float = 0) -> None:
+        """report the result of an allowed call, slow calls count as failures"""
+        failed = not success or latency > self.slow_call
+        if self._state == self.HALF_OPEN:
+            if failed:
+                self._open()
+            else:
+                self._state = self.CLOSED
+                self._results.clear()
+            return
+
+        self._results.append(failed)
+        if len(self._results) >= self.min_calls and sum(self._results) / len(self._results) >= self.failure_rate:
+            self._open()
+
+    def _open(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = self.timer()
+        self._results.clear()
+        self.trips += 1
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
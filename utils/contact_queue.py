@@ -0,0 +1,73 @@
+"""
+per-contact serial work queue with coalescing of rapid-fire messages
+every contact has at most one worker, so the turns of a contact never run concurrently and keep their order.
+messages arriving within `debounce` seconds of each other are handed over together as one turn,
+a burst is closed after `max_delay` seconds at the latest
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, List
+
+
+class ContactQueue():
+
+    def __init__(self,
+                 handler: Callable[[str, list], Awaitable[None]],
+                 debounce: float = 1.0,
+                 max_delay: float = 5.0,
+                 logger=None):
+        self.handler = handler
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.logger = logger
+        self._pending: Dict[str, List] = {}
+        self._arrivals: Dict[str, float] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.messages = 0
+        self.turns = 0
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def submit(self, key: str, item) -> None:
+        """queue an item of a contact, the contact's worker is started if it is not running"""
+        loop = asyncio.get_running_loop()
+        self._pending.setdefault(key, []).append(item)
+        self._arrivals[key] = loop.time()
+        self.messages += 1
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key))
+
+    async def _work(self, key: str) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending.get(key):
+                # wait till the contact stops typing, but not longer than max_delay
+                started = loop.time()
+                while True:
+                    wait = min(self._arrivals[key] + self.debounce, started + self.max_delay) - loop.time()
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+
+                items = self._pending.pop(key)
+                self.turns += 1
+                try:
+                    await self.handler(key, items)
+                except Exception as e:
+                    if self.logger is not None:
+                        self.logger.exception(f'turn of {key} failed: {e}')
+        finally:
+            del self._workers[key]
+            self._arrivals.pop(key, None)
+
+    async def join(self) -> None:
+        """wait till all the queued turns are done"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'active_contacts': len(self._workers),
+            'messages': self.messages,
+            'turns': self.turns,
+        }
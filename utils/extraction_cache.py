@@ -0,0 +1,80 @@
+"""
+persistent cache of UIE extraction results
+results are keyed by the hash of the text, the whole file is tied to a fingerprint of
+the focus.json schema, the model checkpoint and the inference options, a change of any of them drops everything
+"""
+import hashlib
+import json
+import os
+from typing import Optional
+
+
+def model_fingerprint(model_dir: str) -> str:
+    """name, size and mtime of every file in the checkpoint dir"""
+    items = []
+    for root, _, files in os.walk(model_dir):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            items.append(f'{os.path.relpath(path, model_dir)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha256('\n'.join(sorted(items)).encode('utf-8')).hexdigest()
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ExtractionCache():
+    """json file of {text hash: extraction result}"""
+
+    def __init__(self, path: str, schema, model_dir: str, options: Optional[dict] = None):
+        self.path = path
+        self.fingerprint = hashlib.sha256(
+            (json.dumps(schema, ensure_ascii=False, sort_keys=True) + model_fingerprint(model_dir) +
+             json.dumps(options or {}, sort_keys=True)).encode('utf-8')
+        ).hexdigest()
+        self.items = self._load()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('fingerprint') != self.fingerprint:
+            return {}
+        return data.get('items', {})
+
+    def save(self) -> None:
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'items': self.items}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def extract(self, texts: list, func) -> list:
+        """
+        results of func(texts), only texts not seen before are sent to func.
+        entries of texts no longer present are dropped, the file is rewritten if anything changed
+        """
+        keys = [text_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.items and key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+
+        if missing:
+            for key, result in zip(missing.keys(), func(list(missing.values()))):
+                self.items[key] = result
+
+        stale = self.items.keys() - set(keys)
+        for key in stale:
+            del self.items[key]
+        if missing or stale:
+            self.save()
+        return [self.items[key] for key in keys]
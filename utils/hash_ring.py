@@ -0,0 +1,27 @@
+"""
+consistent hash ring
+every node is placed on the ring `replicas` times, a key belongs to the first node point after its hash.
+changing the number of nodes moves only about 1/N of the keys
+"""
+import bisect
+import hashlib
+from typing import Iterable, List
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing():
+
+    def __init__(self, nodes: Iterable, replicas: int = 160):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise RuntimeError('hash ring needs at least one node')
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self._hashes: List[int] = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key: str):
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[i % len(self._nodes)]
@@ -0,0 +1,267 @@
+"""
+in-process fast path for intent classification
+a char n-gram naive bayes model trained from the rasa nlu training data(nlu.yml).
+confident predictions are answered locally, the rest still goes to the rasa server.
+the naive bayes probability alone is overconfident on sentences unlike any training example,
+so a prediction is only taken when the text is an exact training example, or when it is made of
+n-grams seen in training(min_coverage), clearly closer to one intent per n-gram(min_margin)
+and the probability is at least threshold
+
+python -m utils.intent_classifier train <nlu.yml or data dir> [-o model.json] [-t threshold]
+    train on the rasa training data, report the cross-validated fast-path hit rate and export the model
+python -m utils.intent_classifier eval <nlu.yml or data dir> [-m model.json] [-t threshold] [--ood sentences.txt]
+    report hit rate and accuracy of an exported model on some labelled data, and with --ood how many
+    out-of-domain sentences(one per line, none of them should be answered locally) would skip rasa
+"""
+import json
+import math
+import os
+import random
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from utils.rasa_client import normalize
+
+# [text](entity) or [text]{"entity": ...} annotations of rasa examples
+_ANNOTATION = re.compile(r'\[([^\]]+)\](\([^)]*\)|\{[^}]*\})')
+
+
+def load_nlu(path: str) -> List[Tuple[str, str]]:
+    """(text, intent) examples of a rasa nlu yaml file, or of all the yaml files under a directory"""
+    import yaml
+
+    if os.path.isdir(path):
+        files = [os.path.join(root, name) for root, _, names in os.walk(path) for name in sorted(names)
+                 if name.endswith(('.yml', '.yaml'))]
+    else:
+        files = [path]
+
+    examples = []
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as f:
+            data = yaml.safe_load(f) or {}
+        for item in data.get('nlu') or []:
+            if 'intent' not in item:
+                continue
+            for line in (item.get('examples') or '').split('\n'):
+                line = line.strip()
+                if not line.startswith('-'):
+                    continue
+                text = _ANNOTATION.sub(r'\1', line[1:].strip())
+                if text:
+                    examples.append((text, item['intent']))
+    return examples
+
+
+def ngrams(text: str, n_min: int = 1, n_max: int = 3) -> Counter:
+    text = '^' + normalize(text) + '$'
+    return Counter(text[i:i + n] for n in range(n_min, n_max + 1) for i in range(len(text) - n + 1))
+
+
+class IntentClassifier():
+    """multinomial naive bayes over char n-grams, plus exact matches of the training examples"""
+
+    def __init__(self, threshold: float = 0.9, n_max: int = 3, alpha: float = 0.5,
+                 min_coverage: float = 0.4, min_margin: float = 0.3):
+        self.threshold = threshold
+        self.n_max = n_max
+        self.alpha = alpha
+        self.min_coverage = min_coverage
+        self.min_margin = min_margin
+        # n-grams of length 2 and more seen in training
+        self._vocab = set()
+        self.counts: Dict[str, Counter] = {}
+        self.priors: Dict[str, int] = {}
+        self.exact: Dict[str, str] = {}
+        self._loglik: Dict[str, Dict[str, float]] = {}
+        self._unseen: Dict[str, float] = {}
+        self._logprior: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fit(self, examples: List[Tuple[str, str]]) -> 'IntentClassifier':
+        self.counts = {}
+        self.priors = Counter(intent for _, intent in examples)
+        labels = {}
+        for text, intent in examples:
+            self.counts.setdefault(intent, Counter()).update(ngrams(text, 1, self.n_max))
+            labels.setdefault(normalize(text), set()).add(intent)
+        # texts labelled with more than one intent are left to the model
+        self.exact = {text: intents.pop() for text, intents in labels.items() if len(intents) == 1}
+        self._prepare()
+        return self
+
+    def _prepare(self) -> None:
+        vocab = set()
+        for counter in self.counts.values():
+            vocab.update(counter)
+        self._vocab = {gram for gram in vocab if len(gram) > 1}
+        total = sum(self.priors.values())
+        for intent, counter in self.counts.items():
+            denominator = math.log(sum(counter.values()) + self.alpha * (len(vocab) + 1))
+            self._loglik[intent] = {gram: math.log(count + self.alpha) - denominator for gram, count in counter.items()}
+            self._unseen[intent] = math.log(self.alpha) - denominator
+            self._logprior[intent] = math.log(self.priors[intent] / total)
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """
+        (intent, confidence), (None, 0) for an untrained model. the confidence is 1 for exact training examples,
+        0 when the text fails min_coverage or min_margin, otherwise the naive bayes probability
+        """
+        if not self.counts:
+            return None, 0.0
+        intent = self.exact.get(normalize(text))
+        if intent is not None:
+            return intent, 1.0
+
+        grams = ngrams(text, 1, self.n_max)
+        scores = {}
+        for intent, loglik in self._loglik.items():
+            unseen = self._unseen[intent]
+            scores[intent] = self._logprior[intent] + sum(loglik.get(gram, unseen) * count for gram, count in grams.items())
+        ranked = sorted(scores.values(), reverse=True)
+        best = max(scores, key=scores.get)
+
+        # share of the text's longer n-grams seen in training, and the log-likelihood margin per n-gram
+        longer = [gram for gram in grams.elements() if len(gram) > 1]
+        coverage = sum(gram in self._vocab for gram in longer) / len(longer) if longer else 0.0
+        margin = (ranked[0] - ranked[1]) / sum(grams.values()) if len(ranked) > 1 else math.inf
+        if coverage < self.min_coverage or margin < self.min_margin:
+            return best, 0.0
+
+        # softmax probability of the best intent
+        top = scores[best]
+        return best, 1.0 / sum(math.exp(score - top) for score in scores.values())
+
+    def accepts(self, text: str) -> Optional[str]:
+        """the intent if the prediction may skip rasa, otherwise None"""
+        intent, confidence = self.predict(text)
+        if intent is not None and confidence >= self.threshold:
+            return intent
+        return None
+
+    def match(self, text: str) -> Optional[str]:
+        """the intent if the prediction is confident enough, otherwise None and the caller asks rasa"""
+        intent = self.accepts(text)
+        if intent is not None:
+            self.hits += 1
+            return intent
+        self.misses += 1
+        return None
+
+    def save(self, path: str) -> None:
+        model = {
+            'n_max': self.n_max,
+            'alpha': self.alpha,
+            'threshold': self.threshold,
+            'min_coverage': self.min_coverage,
+            'min_margin': self.min_margin,
+            'priors': self.priors,
+            'counts': self.counts,
+            'exact': self.exact,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(model, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, threshold: Optional[float] = None) -> 'IntentClassifier':
+        with open(path, 'r', encoding='utf-8') as f:
+            model = json.load(f)
+        classifier = cls(model['threshold'] if threshold is None else threshold, model['n_max'], model['alpha'],
+                         model.get('min_coverage', 0.4), model.get('min_margin', 0.3))
+        classifier.priors = model['priors']
+        classifier.counts = {intent: Counter(counter) for intent, counter in model['counts'].items()}
+        classifier.exact = model['exact']
+        classifier._prepare()
+        return classifier
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+def evaluate(classifier: IntentClassifier, examples: List[Tuple[str, str]]) -> dict:
+    """fast-path hit rate on examples and the accuracy of the hits"""
+    hits = correct = 0
+    for text, intent in examples:
+        predicted = classifier.accepts(text)
+        if predicted is not None:
+            hits += 1
+            correct += predicted == intent
+    return {
+        'examples': len(examples),
+        'hit_rate': hits / len(examples) if examples else 0.0,
+        'hit_accuracy': correct / hits if hits else 0.0,
+    }
+
+
+def evaluate_ood(classifier: IntentClassifier, texts: List[str]) -> dict:
+    """share of out-of-domain sentences that would wrongly skip rasa, with the intents they would get"""
+    accepted = [(text, classifier.accepts(text)) for text in texts]
+    accepted = [(text, intent) for text, intent in accepted if intent is not None]
+    return {
+        'ood_examples': len(texts),
+        'ood_hit_rate': len(accepted) / len(texts) if texts else 0.0,
+        'ood_hits': accepted,
+    }
+
+
+def load_lines(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def cross_validate(examples: List[Tuple[str, str]], threshold: float, folds: int = 5, seed: int = 0) -> dict:
+    """evaluate on held out folds, exact matches of the held out texts are not available to the model"""
+    examples = list(examples)
+    random.Random(seed).shuffle(examples)
+    hits = correct = 0
+    for k in range(folds):
+        test = examples[k::folds]
+        train = [example for i, example in enumerate(examples) if i % folds != k]
+        report = evaluate(IntentClassifier(threshold).fit(train), test)
+        hits += report['hit_rate'] * len(test)
+        correct += report['hit_accuracy'] * report['hit_rate'] * len(test)
+    return {
+        'examples': len(examples),
+        'hit_rate': hits / len(examples) if examples else 0.0,
+        'hit_accuracy': correct / hits if hits else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m utils.intent_classifier')
+    parser.add_argument('command', choices=['train', 'eval'])
+    parser.add_argument('data', help='rasa nlu.yml or the rasa data directory')
+    parser.add_argument('-o', '-m', '--model', default=os.path.join('drama_configs', 'intent_classifier.json'))
+    parser.add_argument('-t', '--threshold', type=float, default=None)
+    parser.add_argument('--ood', default=None,
+                        help='out-of-domain sentences, one per line, that should all be left to rasa')
+    args = parser.parse_args()
+
+    examples = load_nlu(args.data)
+    if not examples:
+        raise SystemExit(f'no intent examples found in {args.data}')
+
+    if args.command == 'train':
+        threshold = 0.9 if args.threshold is None else args.threshold
+        print('cross validation:', cross_validate(examples, threshold))
+        classifier = IntentClassifier(threshold).fit(examples)
+        if args.ood:
+            print('out of domain:', evaluate_ood(classifier, load_lines(args.ood)))
+        classifier.save(args.model)
+        print(f'{len(examples)} examples of {len(classifier.priors)} intents, exported to: {args.model}')
+    else:
+        classifier = IntentClassifier.load(args.model, args.threshold)
+        print(evaluate(classifier, examples))
+        if args.ood:
+            print('out of domain:', evaluate_ood(classifier, load_lines(args.ood)))
@@ -0,0 +1,90 @@
+"""
+append-only write-ahead journal of json lines
+mutations are appended as they happen, compaction rotates the journal(atomic rename to <path>.old)
+before the snapshot is written and removes the old part afterwards, so no record is lost in between.
+on startup both parts are replayed, a torn last line of a crash is skipped
+"""
+import json
+import os
+import re
+from typing import Iterator, List
+
+
+class Journal():
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.old_path = path + '.old'
+        self.fsync = fsync
+        self.records = 0
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+
+    def replay(self) -> Iterator[dict]:
+        """records of the rotated part(if a compaction was interrupted) and of the current part, in order"""
+        for path in [self.old_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # torn write of a crash, nothing valid can follow it
+                        break
+
+    def rotate(self) -> None:
+        """start a new empty journal, the current records move to <path>.old till discard_old()"""
+        self._file.close()
+        if os.path.exists(self.old_path):
+            # a previous compaction failed, keep its records in front of the current ones
+            with open(self.old_path, 'a', encoding='utf-8') as old, open(self.path, 'r', encoding='utf-8') as f:
+                old.write(f.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self.records = 0
+
+    def discard_old(self) -> None:
+        """the snapshot covering the rotated records is durable"""
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def shard_path(path: str, shard: int, shards: int) -> str:
+    """users.journal for a single process, users.<shard>.journal for every shard of a sharded run"""
+    if shards <= 1:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{shard}{ext}'
+
+
+def orphans(path: str, shard: int, shards: int) -> List[str]:
+    """
+    journals left by a run with another number of shards that this shard takes over:
+    users.<i>.journal goes to shard i % shards, the single process users.journal to shard 0
+    """
+    own = shard_path(path, shard, shards)
+    directory, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    pattern = re.compile(rf'^{re.escape(stem)}(?:\.(\d+))?{re.escape(ext)}(?:\.old)?$')
+    found = set()
+    for file in os.listdir(directory or '.'):
+        match = pattern.match(file)
+        if match is None:
+            continue
+        owner = 0 if match.group(1) is None else int(match.group(1)) % shards
+        journal_path = os.path.join(directory, file[:-len('.old')] if file.endswith('.old') else file)
+        if owner == shard and journal_path != own:
+            found.add(journal_path)
+    return sorted(found)
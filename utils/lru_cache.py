@@ -0,0 +1,58 @@
+"""
+bounded LRU cache with per-entry TTL and hit/miss counters
+not thread-safe, it is meant to be used inside the event loop
+"""
+import time
+from collections import OrderedDict
+
+
+class TTLCache():
+    """LRU cache, entries expire ttl seconds after they are set (ttl=None means never)"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None, timer=time.monotonic):
+        if maxsize <= 0:
+            raise ValueError('maxsize must be positive')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            value, expire = item
+            if expire is None or expire > self.timer():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value) -> None:
+        expire = None if self.ttl is None else self.timer() + self.ttl
+        self._data[key] = (value, expire)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,132 @@
+"""
+per-user memory: every entry is stored once, in time order, and indexed by the entities extracted from it
+retrieval of the latest n entries over a set of entities is a k-way merge of the per-entity indexes,
+every entity keeps at most `cap` entries so that the cost stays bounded however long the user has been chatting
+an entry is a compact (time, speaker id, text) tuple, the "xx说：“...”" form is only rendered for prompts and json
+"""
+import heapq
+import itertools
+import re
+import sys
+import time
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+
+# speaker names are shared by all users, entries only keep the index
+_SPEAKERS = []
+_SPEAKER_IDS = {}
+_UTTERANCE = re.compile(r'^(.+?)说：“(.*)”$', re.S)
+
+
+def speaker_id(speaker: Optional[str]) -> int:
+    """-1 for an entry without speaker"""
+    if speaker is None:
+        return -1
+    if speaker not in _SPEAKER_IDS:
+        _SPEAKER_IDS[speaker] = len(_SPEAKERS)
+        _SPEAKERS.append(speaker)
+    return _SPEAKER_IDS[speaker]
+
+
+def render(speaker: int, text: str) -> str:
+    return text if speaker < 0 else f'{_SPEAKERS[speaker]}说：“{text}”'
+
+
+def parse(utterance: str) -> Tuple[Optional[str], str]:
+    """split a rendered entry of the old format into (speaker, text)"""
+    match = _UTTERANCE.match(utterance)
+    if match is None:
+        return None, utterance
+    return match.group(1), match.group(2)
+
+
+class UserMemory():
+    """time ordered memory entries of one user, indexed by entity"""
+
+    __slots__ = ['cap', '_entries', '_index', '_refs', '_ids']
+
+    def __init__(self, cap: int = 50):
+        self.cap = cap
+        # entry id -> (time, speaker id, text), ids grow with time so id order is time order
+        self._entries = {}
+        # entity -> deque of entry ids, oldest first
+        self._index = {}
+        # entry id -> number of entities referring to it
+        self._refs = {}
+        self._ids = itertools.count()
+
+    def __contains__(self, entity: str) -> bool:
+        return entity in self._index
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def keys(self):
+        return self._index.keys()
+
+    def entries(self):
+        """(time, speaker, text) of all the entries, in time order"""
+        return [(t, _SPEAKERS[speaker] if speaker >= 0 else None, text) for t, speaker, text in self._entries.values()]
+
+    def add(self, text: str, entities: Iterable[str], t: Optional[float] = None,
+            speaker: Optional[str] = None) -> Optional[int]:
+        """store what speaker said once under all the entities, the oldest entry of an entity over cap is evicted"""
+        entities = set(entities)
+        if not entities:
+            return None
+        entry_id = next(self._ids)
+        # equal utterances of different users share one string
+        self._entries[entry_id] = (time.time() if t is None else t, speaker_id(speaker), sys.intern(text))
+        self._refs[entry_id] = len(entities)
+        for entity in entities:
+            ids = self._index.setdefault(entity, deque())
+            ids.append(entry_id)
+            if len(ids) > self.cap:
+                self._release(ids.popleft())
+        return entry_id
+
+    def _release(self, entry_id: int) -> None:
+        self._refs[entry_id] -= 1
+        if self._refs[entry_id] == 0:
+            del self._refs[entry_id]
+            del self._entries[entry_id]
+
+    def recall(self, entities: Iterable[str], n: Optional[int] = None) -> List[Tuple[float, str, int]]:
+        """
+        the latest n entries(all if n is None) of any of the entities, deduplicated, in time order,
+        as (time, rendered text, number of the entities the entry is stored under)
+        """
+        streams = [reversed(self._index[entity]) for entity in set(entities) if entity in self._index]
+        selected = []
+        last = None
+        for entry_id in heapq.merge(*streams, reverse=True):
+            if entry_id == last:
+                selected[-1][2] += 1
+                continue
+            if n is not None and len(selected) >= n:
+                break
+            last = entry_id
+            t, speaker, text = self._entries[entry_id]
+            selected.append([t, render(speaker, text), 1])
+        selected.reverse()
+        return [tuple(entry) for entry in selected]
+
+    def to_dict(self) -> dict:
+        """the user_memory.json format: {entity: [{"time": t, "text": "xx说：“...”"}, ...]}"""
+        rendered = {entry_id: {"time": t, "text": render(speaker, text)}
+                    for entry_id, (t, speaker, text) in self._entries.items()}
+        return {entity: [rendered[i] for i in ids] for entity, ids in self._index.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict, cap: int = 50) -> 'UserMemory':
+        """load the user_memory.json format, entries repeated under several entities are merged"""
+        grouped = {}
+        for entity, items in data.items():
+            for item in items:
+                grouped.setdefault((item['time'], item['text']), set()).add(entity)
+
+        memory = cls(cap)
+        for (t, utterance), entities in sorted(grouped.items(), key=lambda kv: kv[0][0]):
+            speaker, text = parse(utterance)
+            memory.add(text, entities, t, speaker)
+        return memory
@@ -0,0 +1,73 @@
+"""
+prompt assembly under a length budget
+the scene description, the last turn and the current message are always kept,
+memory segments fill what is left of the budget: the most relevant(matching the most entities of the message)
+and the most recent ones first, the kept segments are put back in their original order
+"""
+from typing import Callable, List, Tuple
+
+
+class PromptAssembler():
+    """budget is counted by `counter`, len(characters) by default, pass a tokenizer based one for tokens"""
+
+    def __init__(self, budget: int = 1000, counter: Callable[[str], int] = len, self_memory_share: float = 0.5):
+        self.budget = budget
+        self.counter = counter
+        # part of the memory budget the self memory may take before user memory, unused part goes to user memory
+        self.self_memory_share = self_memory_share
+
+    def _select(self, segments: list, budget: int) -> Tuple[list, int]:
+        """
+        segments are (rank key, order key, text), the best ranked ones which fit in the budget are kept
+        returns the kept texts in order and the used budget
+        """
+        kept = []
+        used = 0
+        for rank, order, text in sorted(segments, key=lambda segment: segment[0], reverse=True):
+            size = self.counter(text)
+            if used + size <= budget:
+                kept.append((order, text))
+                used += size
+        kept.sort(key=lambda item: item[0])
+        return [text for _, text in kept], used
+
+    def build(self,
+              description: str,
+              self_memory: List[Tuple[str, int]],
+              user_memory: List[Tuple[float, str, int]],
+              last_dialog: str,
+              character: str,
+              text: str,
+              addition: str = '',
+              reserve: int = 0) -> str:
+        """
+        self_memory: (line, relevance: number of matched entities or similarity score) in memory.txt order
+        user_memory: (time, rendered entry, number of matched entities)
+        reserve: budget kept free for what is appended after the pre-prompt, e.g. the action
+        """
+        current = character + "说：“" + text + "”你" + addition
+        fixed = self.counter(description) + self.counter(current) + len("，，你记得：……现在")
+        available = self.budget - reserve - fixed
+
+        # the last turn is the most important context, only its beginning is cut if even it does not fit
+        if self.counter(last_dialog) > max(available, 0):
+            while last_dialog and self.counter(last_dialog) > max(available, 0):
+                last_dialog = last_dialog[max(1, len(last_dialog) // 10):]
+        available -= self.counter(last_dialog)
+
+        self_texts, used = self._select([(hits, order, line) for order, (line, hits) in enumerate(self_memory)],
+                                        int(max(available, 0) * self.self_memory_share))
+        user_texts, _ = self._select([((hits, t), t, entry) for t, entry, hits in user_memory],
+                                     max(available - used, 0))
+
+        selfmemory_text = ''.join(self_texts)
+        memory_text = ''.join(user_texts)
+        if selfmemory_text:
+            pre_prompt = "你记得：" + selfmemory_text + "……现在" + description
+        else:
+            pre_prompt = description
+        if memory_text:
+            pre_prompt += "，" + memory_text + "，" + last_dialog
+        else:
+            pre_prompt += "，" + last_dialog
+        return pre_prompt + current
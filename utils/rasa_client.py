@@ -0,0 +1,103 @@
+"""
+async client of the rasa nlu server (/model/parse)
+keep-alive connection pool, per-request timeout and bounded concurrency,
+so that intent lookups of different users overlap instead of blocking the wechaty event loop
+intent results are cached by normalized text, the cache is dropped when rasa loads another model
+"""
+import asyncio
+import json
+import time
+from typing import Optional
+
+import aiohttp
+
+from utils.lru_cache import TTLCache
+
+
+def normalize(text: str) -> str:
+    """cache key of a message: lower case, whitespace collapsed"""
+    return ' '.join(text.split()).lower()
+
+
+class RasaClient():
+    """async intent client for rasa http api"""
+
+    def __init__(self,
+                 url: str = 'http://localhost:5005',
+                 timeout: float = 5,
+                 max_concurrency: int = 8,
+                 pool_size: int = 16,
+                 keepalive_timeout: float = 60,
+                 cache: Optional[TTLCache] = None,
+                 version_check_interval: float = 60):
+        self.url = url.rstrip('/')
+        self.parse_url = self.url + '/model/parse'
+        self.status_url = self.url + '/status'
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+
+        self.cache = cache
+        self.version_check_interval = version_check_interval
+        self.model_version = None
+        self._version_checked = 0.0
+
+        # session and semaphore must be created inside the running loop
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def parse(self, text: str) -> dict:
+        """return the full parse result of rasa"""
+        session = self._ensure_session()
+        async with self._semaphore:
+            async with session.post(self.parse_url, data=json.dumps({'text': text})) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def _check_model_version(self) -> None:
+        """drop the cached intents if rasa serves another model than last time"""
+        now = time.monotonic()
+        if now - self._version_checked < self.version_check_interval:
+            return
+        self._version_checked = now
+
+        session = self._ensure_session()
+        try:
+            async with session.get(self.status_url) as response:
+                response.raise_for_status()
+                status = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            # status endpoint not reachable(e.g. token protected), keep relying on the ttl
+            return
+
+        version = status.get('model_id') or status.get('fingerprint') or status.get('model_file')
+        if version != self.model_version:
+            if self.model_version is not None:
+                self.cache.clear()
+            self.model_version = version
+
+    async def intent(self, text: str) -> str:
+        if self.cache is None:
+            result = await self.parse(text)
+            return result['intent']['name']
+
+        await self._check_model_version()
+        key = normalize(text)
+        intent = self.cache.get(key)
+        if intent is None:
+            result = await self.parse(text)
+            intent = result['intent']['name']
+            self.cache.set(key, intent)
+        return intent
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,76 @@
+"""
+semantic retrieval over the self memory(memory.txt lines)
+every line is embedded once at load time into a row normalized numpy matrix,
+a turn costs one embedding of the message and one matrix-vector product for the cosine top-k
+embedders:
+  HashingEmbedder: char n-gram feature hashing, no model needed
+  BowEmbedder: bag-of-words average of paddlenlp word vectors, the same kind of model as simnet_bow, runs on CPU
+"""
+import zlib
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+
+class HashingEmbedder():
+    """char 1..ngram grams hashed into dim buckets"""
+
+    def __init__(self, dim: int = 1024, ngram: int = 2):
+        self.dim = dim
+        self.ngram = ngram
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for n in range(1, self.ngram + 1):
+                for i in range(len(text) - n + 1):
+                    matrix[row, zlib.crc32(text[i:i + n].encode('utf-8')) % self.dim] += 1
+        return matrix
+
+
+class BowEmbedder():
+    """average of the word vectors of the jieba tokens of a text"""
+
+    def __init__(self, embedding_name: str = 'w2v.baidu_encyclopedia.target.word-word.dim300'):
+        from paddlenlp.embeddings import TokenEmbedding
+        from paddlenlp.data import JiebaTokenizer
+        self.embedding = TokenEmbedding(embedding_name)
+        self.tokenizer = JiebaTokenizer(self.embedding.vocab)
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.embedding.embedding_dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = self.tokenizer.cut(text)
+            if words:
+                matrix[row] = self.embedding.search(words).mean(axis=0)
+        return matrix
+
+
+class SemanticIndex():
+
+    def __init__(self, embed: Callable[[List[str]], np.ndarray], top_k: int = 5, min_score: float = 0.2):
+        self.embed = embed
+        self.top_k = top_k
+        self.min_score = min_score
+        self.lines = []
+        self.matrix = None
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def build(self, lines: List[str]) -> None:
+        self.lines = list(lines)
+        self.matrix = self._normalize(self.embed(self.lines)) if self.lines else None
+
+    def search(self, text: str, top_k: int = None) -> List[Tuple[str, float]]:
+        """(line, cosine score) of the top_k lines scoring at least min_score, best first"""
+        if self.matrix is None:
+            return []
+        top_k = min(top_k or self.top_k, len(self.lines))
+        scores = self.matrix @ self._normalize(self.embed([text]))[0]
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.lines[i], float(scores[i])) for i in best if scores[i] >= self.min_score]
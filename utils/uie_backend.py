@@ -0,0 +1,219 @@
+"""
+CPU inference options of the UIE model
+fp32: the static graph exported from the checkpoint(<model_dir>/static), as Taskflow does on first load
+int8: the static graph with weights quantized to int8 by paddleslim(quant_post_dynamic), kept in <model_dir>_int8.
+      paddleslim is optional, it is only needed to build the int8 model
+max_seq_len caps the tokens of one window(paddlenlp splits longer texts), num_threads the intra-op threads
+
+python -m utils.uie_backend quantize [--model uie/checkpoint/model_best]
+    build the int8 model ahead of the first start
+python -m utils.uie_backend compare [configs dir] [--model uie/checkpoint/model_best] [--max-seq-len 512 256 128] [--threads 4]
+    accuracy against fp32/512, latency and peak RSS of every variant over the memory.txt lines
+"""
+import json
+import os
+import shutil
+from typing import Optional
+
+from utils.extraction_cache import model_fingerprint
+
+PRECISIONS = ['fp32', 'int8']
+STATIC_DIR = 'static'
+MODEL_FILE = 'inference.pdmodel'
+PARAMS_FILE = 'inference.pdiparams'
+SOURCE_FILE = 'source_fingerprint'
+
+
+def static_model_exists(model_dir: str) -> bool:
+    return os.path.exists(os.path.join(model_dir, STATIC_DIR, MODEL_FILE))
+
+
+def export_static(model_dir: str, schema=None) -> None:
+    """export the static graph of the checkpoint, Taskflow converts the dygraph params when it is missing"""
+    if static_model_exists(model_dir):
+        return
+    from paddlenlp import Taskflow
+    Taskflow('information_extraction', schema=schema or ['时间'], task_path=model_dir)
+    if not static_model_exists(model_dir):
+        raise RuntimeError(f'no static model exported to {os.path.join(model_dir, STATIC_DIR)}')
+
+
+def quantize(model_dir: str, out_dir: Optional[str] = None) -> str:
+    """
+    int8 copy of the checkpoint for Taskflow(task_path=out_dir), rebuilt when the checkpoint changed.
+    tokenizer and config files are copied, the static graph is replaced by the quantized one
+    """
+    out_dir = out_dir or model_dir.rstrip('/\\') + '_int8'
+    export_static(model_dir)
+    source = model_fingerprint(model_dir)
+    source_file = os.path.join(out_dir, SOURCE_FILE)
+    if static_model_exists(out_dir) and os.path.exists(source_file):
+        with open(source_file, 'r', encoding='utf-8') as f:
+            if f.read() == source:
+                return out_dir
+
+    try:
+        from paddleslim.quant import quant_post_dynamic
+    except ImportError:
+        raise RuntimeError("uie_precision='int8' needs paddleslim to quantize the model, "
+                           "pip install paddleslim(matching the installed paddlepaddle) or use 'fp32'")
+
+    tmp_dir = out_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.copytree(model_dir, tmp_dir, ignore=shutil.ignore_patterns(STATIC_DIR))
+    quant_post_dynamic(model_dir=os.path.join(model_dir, STATIC_DIR),
+                       save_model_dir=os.path.join(tmp_dir, STATIC_DIR),
+                       model_filename=MODEL_FILE,
+                       params_filename=PARAMS_FILE,
+                       save_model_filename=MODEL_FILE,
+                       save_params_filename=PARAMS_FILE,
+                       quantizable_op_type=['matmul', 'matmul_v2', 'mul'],
+                       weight_bits=8)
+    with open(os.path.join(tmp_dir, SOURCE_FILE), 'w', encoding='utf-8') as f:
+        f.write(source)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def prepare(model_dir: str, precision: str = 'fp32') -> str:
+    """
+    task_path of the model in the given precision, the static graph is exported here once
+    so that the workers of a pool do not all convert it into the same directory
+    """
+    if precision not in PRECISIONS:
+        raise RuntimeError(f'uie precision must be one of {PRECISIONS}')
+    if precision == 'int8':
+        return quantize(model_dir)
+    export_static(model_dir)
+    return model_dir
+
+
+def taskflow_kwargs(batch_size: int = 1, max_seq_len: int = 512, num_threads: Optional[int] = None) -> dict:
+    kwargs = {'batch_size': batch_size, 'max_seq_len': max_seq_len}
+    if num_threads:
+        kwargs['num_threads'] = num_threads
+    return kwargs
+
+
+def _peak_rss_mb() -> float:
+    import resource
+    import sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def _entities(result: dict) -> set:
+    """the entities nlu_info keeps"""
+    return {(label, entity['text']) for label, entities in result.items() for entity in entities
+            if entity['probability'] > 0.6}
+
+
+def _run_variant(schema, texts: list, task_path: str, kwargs: dict, results) -> None:
+    """load and run one variant in a fresh process, so that its peak RSS is its own"""
+    import time
+    from paddlenlp import Taskflow
+
+    started = time.perf_counter()
+    uie = Taskflow('information_extraction', schema=schema, task_path=task_path, **kwargs)
+    load_time = time.perf_counter() - started
+    uie(texts[:1])
+
+    latencies = []
+    outputs = []
+    for text in texts:
+        started = time.perf_counter()
+        outputs.append(uie([text])[0])
+        latencies.append(time.perf_counter() - started)
+    results.put({
+        'load_s': load_time,
+        'latencies': latencies,
+        'entities': [sorted(_entities(output)) for output in outputs],
+        'rss_mb': _peak_rss_mb(),
+    })
+
+
+def _wait_result(process, results, timeout: float) -> dict:
+    """the report of a variant process, RuntimeError if it exits without one or takes longer than timeout"""
+    import queue
+    import time
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            raise RuntimeError(f'{process.name} exited with {process.exitcode} before reporting')
+        if time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError(f'{process.name} did not finish in {timeout}s')
+
+
+def compare(configs: str, model_dir: str, max_seq_lens: list, num_threads: Optional[int] = None,
+            timeout: float = 3600) -> list:
+    """one report per precision and max_seq_len, accuracy is measured against fp32 with the first max_seq_len"""
+    import multiprocessing
+
+    with open(os.path.join(configs, 'focus.json'), 'r', encoding='utf-8') as f:
+        schema = json.load(f)
+    with open(os.path.join(configs, 'memory.txt'), 'r', encoding='utf-8') as f:
+        texts = [line.strip() for line in f.readlines() if line.strip()]
+
+    ctx = multiprocessing.get_context('spawn')
+    reports = []
+    baseline = None
+    for precision in PRECISIONS:
+        task_path = prepare(model_dir, precision)
+        for max_seq_len in max_seq_lens:
+            results = ctx.Queue()
+            process = ctx.Process(target=_run_variant, name=f'uie {precision}/{max_seq_len}',
+                                  args=(schema, texts, task_path, taskflow_kwargs(1, max_seq_len, num_threads), results))
+            process.start()
+            try:
+                run = _wait_result(process, results, timeout)
+            finally:
+                process.join()
+
+            entities = [set(map(tuple, items)) for items in run['entities']]
+            if baseline is None:
+                baseline = entities
+            hits = sum(len(a & b) for a, b in zip(entities, baseline))
+            found = sum(len(a) for a in entities)
+            expected = sum(len(b) for b in baseline)
+            latencies = sorted(run['latencies'])
+            reports.append({
+                'precision': precision,
+                'max_seq_len': max_seq_len,
+                'precision_vs_base': hits / found if found else 1.0,
+                'recall_vs_base': hits / expected if expected else 1.0,
+                'mean_ms': 1000 * sum(latencies) / len(latencies),
+                'p50_ms': 1000 * latencies[len(latencies) // 2],
+                'p95_ms': 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                'load_s': run['load_s'],
+                'rss_mb': run['rss_mb'],
+            })
+    return reports
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m utils.uie_backend')
+    parser.add_argument('command', choices=['compare', 'quantize'])
+    parser.add_argument('configs', nargs='?', default='drama_configs')
+    parser.add_argument('--model', default='uie/checkpoint/model_best')
+    parser.add_argument('--max-seq-len', type=int, nargs='+', default=[512, 256, 128])
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'quantize':
+        print('int8 model in:', quantize(args.model))
+    else:
+        columns = ['precision', 'max_seq_len', 'precision_vs_base', 'recall_vs_base',
+                   'mean_ms', 'p50_ms', 'p95_ms', 'load_s', 'rss_mb']
+        print('\t'.join(columns))
+        for report in compare(args.configs, args.model, args.max_seq_len, args.threads):
+            print('\t'.join(f'{report[c]:.3f}' if isinstance(report[c], float) else str(report[c]) for c in columns))
@@ -0,0 +1,250 @@
+"""
+run the paddlenlp UIE Taskflow in a pool of worker processes
+every worker loads the model once and has request and result queues of its own, the pool hands a job
+to an idle worker.
+a monitor thread restarts crashed or hung workers and re-queues the job they were running
+the pool is callable like the Taskflow itself: pool(texts) -> results
+"""
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional
+
+
+def _worker_main(worker_id: int, schema, task_path: str, taskflow_kwargs: dict, requests, results) -> None:
+    try:
+        from paddlenlp import Taskflow
+        uie = Taskflow('information_extraction', schema=schema, task_path=task_path, **taskflow_kwargs)
+    except Exception as e:
+        results.put(('failed', worker_id, None, repr(e)))
+        return
+    results.put(('ready', worker_id, None, None))
+
+    while True:
+        job = requests.get()
+        if job is None:
+            return
+        job_id, texts = job
+        try:
+            results.put(('done', worker_id, job_id, uie(texts)))
+        except Exception as e:
+            results.put(('error', worker_id, job_id, repr(e)))
+
+
+class UIEProcessPool():
+    """UIE extraction on N worker processes"""
+
+    def __init__(self,
+                 workers: int,
+                 schema,
+                 task_path: str,
+                 taskflow_kwargs: Optional[dict] = None,
+                 chunk_size: int = 16,
+                 job_timeout: float = 60,
+                 health_interval: float = 1,
+                 max_retries: int = 1,
+                 logger=None):
+        if workers <= 0:
+            raise ValueError('workers must be positive')
+        self.workers = workers
+        self.schema = schema
+        self.task_path = task_path
+        self.taskflow_kwargs = taskflow_kwargs or {}
+        self.chunk_size = chunk_size
+        self.job_timeout = job_timeout
+        self.health_interval = health_interval
+        self.max_retries = max_retries
+        self.logger = logger
+
+        # paddle is not fork-safe
+        self._ctx = multiprocessing.get_context('spawn')
+        # worker_id -> request/result queue, a restarted worker gets new ones: a worker killed inside get()
+        # or while sending a result may keep holding the lock of its queue
+        self._requests = {}
+        self._results = {}
+        self._processes = {}
+        self._ready = set()
+        self._idle = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        # job_id -> [texts, future, retries, deadline], the deadline is None while the job waits for a worker
+        self._jobs = {}
+        # job_ids waiting for an idle worker
+        self._backlog = deque()
+        # worker_id -> job_id
+        self._running = {}
+        self._closed = False
+        self.restarts = 0
+
+    def _log(self, message: str) -> None:
+        if self.logger is not None:
+            self.logger.warning(message)
+
+    def _spawn(self, worker_id: int) -> None:
+        requests = self._requests.get(worker_id)
+        if requests is not None:
+            requests.cancel_join_thread()
+            requests.close()
+        self._requests[worker_id] = self._ctx.Queue()
+        # the collector of the old result queue stops once it sees the queue replaced
+        results = self._results[worker_id] = self._ctx.Queue()
+        process = self._ctx.Process(target=_worker_main,
+                                    args=(worker_id, self.schema, self.task_path, self.taskflow_kwargs,
+                                          self._requests[worker_id], results),
+                                    name=f'uie-worker-{worker_id}',
+                                    daemon=True)
+        process.start()
+        self._processes[worker_id] = process
+        threading.Thread(target=self._collect, args=(worker_id, results),
+                         name=f'uie-pool-collector-{worker_id}', daemon=True).start()
+
+    def start(self, timeout: float = 300) -> None:
+        """start the workers and wait till all of them loaded the model"""
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        deadline = time.monotonic() + timeout
+        while len(self._ready) < self.workers:
+            if self._failed:
+                self.close()
+                raise RuntimeError(f'uie worker failed to load the model: {self._failed}')
+            if any(not process.is_alive() for process in self._processes.values()):
+                self.close()
+                raise RuntimeError('uie worker exited while loading the model')
+            if time.monotonic() > deadline:
+                self.close()
+                raise RuntimeError('uie workers did not get ready in time')
+            time.sleep(0.1)
+        threading.Thread(target=self._monitor, name='uie-pool-monitor', daemon=True).start()
+
+    def submit(self, texts: list) -> Future:
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('uie pool is closed')
+            job_id = next(self._job_ids)
+            self._jobs[job_id] = [texts, future, 0, None]
+            self._backlog.append(job_id)
+            self._dispatch()
+        return future
+
+    def _dispatch(self) -> None:
+        """hand the waiting jobs to the idle workers, the deadline of a job starts here. called with the lock held"""
+        while self._backlog and self._idle:
+            job_id = self._backlog.popleft()
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            worker_id = self._idle.pop()
+            self._running[worker_id] = job_id
+            job[3] = time.monotonic() + self.job_timeout
+            self._requests[worker_id].put((job_id, job[0]))
+
+    def __call__(self, texts) -> list:
+        """blocking extraction, big inputs are split into chunks so that all workers share them"""
+        if isinstance(texts, str):
+            texts = [texts]
+        futures = [self.submit(texts[i:i + self.chunk_size]) for i in range(0, len(texts), self.chunk_size)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def _collect(self, worker_id: int, results) -> None:
+        while True:
+            try:
+                kind, _, job_id, payload = results.get(timeout=self.health_interval)
+            except queue.Empty:
+                if self._closed or self._results.get(worker_id) is not results:
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                if kind == 'ready':
+                    self._ready.add(worker_id)
+                    self._idle.add(worker_id)
+                    self._dispatch()
+                elif kind == 'failed':
+                    self._failed[worker_id] = payload
+                elif kind in ['done', 'error']:
+                    if self._running.get(worker_id) == job_id:
+                        del self._running[worker_id]
+                        self._idle.add(worker_id)
+                    job = self._jobs.pop(job_id, None)
+                    if job is not None:
+                        if kind == 'done':
+                            job[1].set_result(payload)
+                        else:
+                            job[1].set_exception(RuntimeError(f'uie extraction failed: {payload}'))
+                    self._dispatch()
+
+    def _retry(self, job_id: int, reason: str) -> None:
+        """re-queue a lost job, or fail it once it used up its retries. called with the lock held"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        if job[2] >= self.max_retries:
+            del self._jobs[job_id]
+            job[1].set_exception(RuntimeError(f'uie extraction failed: {reason}'))
+            return
+        job[2] += 1
+        job[3] = None
+        self._backlog.appendleft(job_id)
+
+    def _monitor(self) -> None:
+        """health check: restart dead or hung workers, re-queue the jobs they held"""
+        while not self._closed:
+            time.sleep(self.health_interval)
+            now = time.monotonic()
+            with self._lock:
+                if self._closed:
+                    return
+                for worker_id, process in list(self._processes.items()):
+                    job_id = self._running.get(worker_id)
+                    hung = job_id in self._jobs and self._jobs[job_id][3] is not None and self._jobs[job_id][3] < now
+                    if process.is_alive() and not hung:
+                        continue
+
+                    if hung:
+                        process.kill()
+                    process.join(1)
+                    self._log(f'uie worker {worker_id} {"hung" if hung else "died"}(exitcode {process.exitcode}), restarting')
+                    self._ready.discard(worker_id)
+                    self._idle.discard(worker_id)
+                    self._running.pop(worker_id, None)
+                    if job_id is not None:
+                        self._retry(job_id, f'worker {worker_id} {"hung" if hung else "crashed"}')
+                    self.restarts += 1
+                    self._spawn(worker_id)
+                self._dispatch()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for job in self._jobs.values():
+                job[1].set_exception(RuntimeError('uie pool is closed'))
+            self._jobs.clear()
+        for requests in self._requests.values():
+            requests.put(None)
+        for process in self._processes.values():
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': len(self._processes),
+                'ready': len(self._ready),
+                'busy': len(self._running),
+                'queued_jobs': len(self._jobs),
+                'restarts': self.restarts,
+            }
@@ -0,0 +1,306 @@
+"""
+tiered storage of user sessions
+all users live in a sqlite file on local disk, a user is loaded lazily on the first message
+and kept in an in-memory LRU of active sessions, idle or least recently used sessions are dropped(changed
+ones after the next compaction wrote them), so resident memory scales with concurrent users rather than total users
+status and memory mutations are appended to a journal as they happen, compact() periodically writes
+the changed sessions to sqlite in the background, replay() recovers what a crash did not write
+"""
+import asyncio
+import copy
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from utils.journal import Journal
+from utils.memory_store import UserMemory, parse
+
+
+class Session():
+    """state of one user: status [character, scenario], memory and the last turn dialog"""
+
+    __slots__ = ['contact_id', 'status', 'memory', 'last_turn', 'dirty', 'last_active']
+
+    def __init__(self, contact_id: str, status: list, memory: UserMemory, last_turn: dict):
+        self.contact_id = contact_id
+        self.status = status
+        self.memory = memory
+        self.last_turn = last_turn
+        self.dirty = False
+        self.last_active = time.monotonic()
+
+    @property
+    def character(self) -> str:
+        return self.status[0]
+
+    @property
+    def scenario(self) -> str:
+        return self.status[1]
+
+
+class UserStore():
+    """sqlite table of users, memory and last turn are stored as json"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # shards of a multi-process run share the file, WAL lets their reads and writes overlap
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS users ('
+                            'contact_id TEXT PRIMARY KEY, status TEXT, memory TEXT, last_turn TEXT, updated REAL)')
+        # loads of the event loop thread, WAL readers neither wait for the writes nor for self.lock
+        self._reader = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def load(self, contact_id: str) -> Optional[tuple]:
+        """(status, memory dict, last_turn dict or None)"""
+        row = self._reader.execute('SELECT status, memory, last_turn FROM users WHERE contact_id = ?',
+                                   (contact_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), json.loads(row[2]) if row[2] else None
+
+    @staticmethod
+    def rows(sessions: list) -> list:
+        """serialize sessions, must run in the thread that mutates them"""
+        return [(session.contact_id, json.dumps(session.status, ensure_ascii=False),
+                 json.dumps(session.memory.to_dict(), ensure_ascii=False),
+                 json.dumps(session.last_turn, ensure_ascii=False), time.time()) for session in sessions]
+
+    def write_rows(self, rows: list) -> None:
+        """one transaction, safe to run on a worker thread"""
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)', rows)
+
+    def save_many(self, sessions: list) -> None:
+        self.write_rows(self.rows(sessions))
+
+    def import_json(self, users: dict, user_memory: dict) -> None:
+        """one-off migration of users.json/user_memory.json"""
+        rows = [(key, json.dumps(status, ensure_ascii=False),
+                 json.dumps(user_memory.get(key, {}), ensure_ascii=False), None, time.time())
+                for key, status in users.items()]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?)', rows)
+
+    def close(self) -> None:
+        self._reader.close()
+        with self.lock:
+            self.db.close()
+
+
+class SessionCache():
+    """LRU of active sessions in front of a UserStore"""
+
+    def __init__(self,
+                 store: UserStore,
+                 last_turn_template: dict,
+                 capacity: int = 1000,
+                 idle_timeout: float = 1800,
+                 memory_cap: int = 50,
+                 journal: Optional[Journal] = None):
+        self.store = store
+        self.journal = journal
+        self.last_turn_template = last_turn_template
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.memory_cap = memory_cap
+        self._sessions = OrderedDict()
+        # evicted sessions with changes, kept till the next compaction writes them
+        self._evicted = {}
+        self.loads = 0
+        self.evictions = 0
+        # journal records of users missing from the store(e.g. users.db deleted), skipped by replay()
+        self.replay_skipped = 0
+        # created on first use, the loop may not run yet when the cache is made
+        self._compact_lock = None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def new_last_turn(self) -> dict:
+        return copy.deepcopy(self.last_turn_template)
+
+    def get(self, contact_id: str) -> Optional[Session]:
+        """the active session, loaded from disk if needed, None for unknown users"""
+        session = self._sessions.get(contact_id)
+        if session is None and contact_id in self._evicted:
+            session = self._evicted[contact_id]
+            self._put(session)
+        elif session is None:
+            row = self.store.load(contact_id)
+            if row is None:
+                return None
+            status, memory, last_turn = row
+            # the people of the scenarios may have changed since the last turn was stored
+            if last_turn is None or last_turn.keys() != self.last_turn_template.keys():
+                last_turn = self.new_last_turn()
+            session = Session(contact_id, status, UserMemory.from_dict(memory, self.memory_cap), last_turn)
+            self.loads += 1
+            self._put(session)
+        else:
+            self._sessions.move_to_end(contact_id)
+        session.last_active = time.monotonic()
+        return session
+
+    def create(self, contact_id: str, status: list) -> Session:
+        session = Session(contact_id, status, UserMemory(self.memory_cap), self.new_last_turn())
+        self._log({'op': 'status', 'id': contact_id, 'status': status})
+        session.dirty = True
+        self._put(session)
+        return session
+
+    def set_status(self, session: Session, character: str, scenario: str) -> None:
+        session.status = [character, scenario]
+        self._log({'op': 'status', 'id': session.contact_id, 'status': session.status})
+        self.touch(session)
+
+    def remember(self, session: Session, speaker: str, text: str, entities, t: Optional[float] = None) -> None:
+        """add what speaker said to the memory, journaled so that it survives a crash before the next compaction"""
+        entities = list(dict.fromkeys(entities))
+        if not entities:
+            return
+        t = time.time() if t is None else t
+        session.memory.add(text, entities, t, speaker)
+        self._log({'op': 'memory', 'id': session.contact_id, 'time': t, 'speaker': speaker, 'text': text,
+                   'entities': entities})
+        self.touch(session)
+
+    def _log(self, record: dict) -> None:
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def replay(self, journal: Optional[Journal] = None) -> int:
+        """
+        apply the journal(or the given one) on top of the store after a restart, returns the number of records.
+        the replayed sessions are written back and dropped, they are loaded from the store again when needed
+        """
+        journal = journal or self.journal
+        if journal is None:
+            return 0
+        count = 0
+        seen = {}
+        for record in journal.replay():
+            count += 1
+            contact_id = record['id']
+            session = self.get(contact_id)
+            if record['op'] == 'status':
+                if session is None:
+                    session = Session(contact_id, record['status'], UserMemory(self.memory_cap), self.new_last_turn())
+                    self._put(session)
+                session.status = record['status']
+            elif session is None:
+                # memory of a user the store does not have, nothing to attach it to
+                self.replay_skipped += 1
+                continue
+            elif record['op'] == 'memory':
+                # records already written to the store before the crash must not be added twice
+                if contact_id not in seen or seen[contact_id][0] is not session:
+                    seen[contact_id] = (session, set(session.memory.entries()))
+                if 'speaker' in record:
+                    speaker, text = record['speaker'], record['text']
+                else:
+                    # journals written before entries were stored compactly
+                    speaker, text = parse(record['text'])
+                entry = (record['time'], speaker, text)
+                if entry not in seen[contact_id][1]:
+                    session.memory.add(text, record['entities'], record['time'], speaker)
+                    seen[contact_id][1].add(entry)
+            session.dirty = True
+        self.flush()
+        self._sessions.clear()
+        self._evicted.clear()
+        journal.rotate()
+        journal.discard_old()
+        return count
+
+    def touch(self, session: Session) -> None:
+        """mark a session as changed, a session evicted while its turn was running is put back"""
+        session.dirty = True
+        session.last_active = time.monotonic()
+        if session.contact_id in self._sessions:
+            self._sessions.move_to_end(session.contact_id)
+        else:
+            self._put(session)
+
+    def _put(self, session: Session) -> None:
+        self._evicted.pop(session.contact_id, None)
+        self._sessions[session.contact_id] = session
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        drop the idle sessions and the least recently used ones over capacity.
+        changed ones wait for the next compaction, the event loop never writes to the store
+        """
+        now = time.monotonic()
+        while self._sessions:
+            contact_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.capacity and now - session.last_active < self.idle_timeout:
+                break
+            del self._sessions[contact_id]
+            if session.dirty:
+                self._evicted[contact_id] = session
+            self.evictions += 1
+
+    @property
+    def unsaved(self) -> int:
+        """evicted sessions waiting for the next compaction"""
+        return len(self._evicted)
+
+    def flush(self) -> None:
+        """write all the dirty sessions to disk, blocking"""
+        dirty = self._dirty()
+        if dirty:
+            self.store.save_many(dirty)
+            for session in dirty:
+                session.dirty = False
+        self._evicted.clear()
+
+    def _dirty(self) -> list:
+        return [session for session in self._sessions.values() if session.dirty] + \
+               [session for session in self._evicted.values() if session.dirty]
+
+    async def compact(self) -> None:
+        """
+        rotate the journal, write the changed sessions to the store on a worker thread,
+        then drop the rotated journal. the event loop only serializes the changed sessions.
+        compactions run one at a time, the rotated journal of one must not be dropped by another
+        """
+        if self._compact_lock is None:
+            self._compact_lock = asyncio.Lock()
+        async with self._compact_lock:
+            dirty = self._dirty()
+            if self.journal is not None:
+                self.journal.rotate()
+            rows = self.store.rows(dirty)
+            for session in dirty:
+                session.dirty = False
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.store.write_rows, rows)
+            except BaseException:
+                # failed or cancelled, the sessions are written by the next compaction
+                for session in dirty:
+                    session.dirty = True
+                raise
+            for session in dirty:
+                if not session.dirty and self._evicted.get(session.contact_id) is session:
+                    del self._evicted[session.contact_id]
+            if self.journal is not None:
+                self.journal.discard_old()
+
+    def stats(self) -> dict:
+        return {
+            'active': len(self._sessions),
+            'unsaved': len(self._evicted),
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,91 @@
+"""
+write-behind queue for the bookkeeping after a reply has been sent
+jobs run on background workers, the bounded queue makes the producer wait when the workers fall behind.
+barrier(key) waits till the queued jobs of a key are done, so the next turn of a contact sees them(read-your-writes),
+flush()/close() wait till all the queued jobs are done(shutdown)
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+
+
+class WriteBehind():
+
+    def __init__(self, maxsize: int = 256, workers: int = 2, logger=None):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.logger = logger
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._pending: Dict[str, int] = {}
+        self._idle: Dict[str, asyncio.Event] = {}
+        self.done = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """start the workers, needs the running loop"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def submit(self, key: str, job: Callable[[], Awaitable[None]]) -> None:
+        """queue a job of key, waits while the queue is full"""
+        self.start()
+        self._pending[key] = self._pending.get(key, 0) + 1
+        if key not in self._idle:
+            self._idle[key] = asyncio.Event()
+        self._idle[key].clear()
+        try:
+            await self._queue.put((key, job))
+        except BaseException:
+            self._finish(key)
+            raise
+
+    async def _work(self) -> None:
+        while True:
+            key, job = await self._queue.get()
+            try:
+                await job()
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                if self.logger is not None:
+                    self.logger.exception(f'write-behind job of {key} failed: {e}')
+            finally:
+                self._finish(key)
+                self._queue.task_done()
+
+    def _finish(self, key: str) -> None:
+        self._pending[key] -= 1
+        if self._pending[key] == 0:
+            del self._pending[key]
+            self._idle.pop(key).set()
+
+    async def barrier(self, key: str) -> None:
+        """wait till the jobs of key queued so far are done"""
+        if key in self._idle:
+            await self._idle[key].wait()
+
+    async def flush(self) -> None:
+        """wait till all the queued jobs are done"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self) -> None:
+        """flush and stop the workers"""
+        await self.flush()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def __len__(self) -> int:
+        return sum(self._pending.values())
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self),
+            'done': self.done,
+            'failed': self.failed,
+        }